@@ -6,19 +6,32 @@ import itertools
 import logging
 import os
 import threading
+import time
 
 from collections import defaultdict, Counter
 
 import multiprocessing as mp
 
+import numpy as np
+
 import seqbot.demuxer.bcl2fu as bcl2fu
+import seqbot.demuxer.checkpoint as checkpoint
+import seqbot.demuxer.columnar as columnar
+import seqbot.demuxer.index_hopping as index_hopping
+import seqbot.demuxer.storage as storage
 
-import utilities.logging as ut_log
+import utilities.log_util as ut_log
 
 
 cbcl_data = defaultdict(dict)
 cbcl_filter_data = defaultdict(dict)
 
+# the arguments that have to match to resume a run
+RUN_PARAMS = ('bcl_path', 'index_cycle_start', 'index_cycle_end',
+              'output_format', 'n_threads', 'lane', 'part',
+              'tile_start', 'tile_end', 'samplesheet', 'i7_cycles', 'i5_rc',
+              'store_dir')
+
 
 def get_parser():
     parser = argparse.ArgumentParser(
@@ -29,37 +42,153 @@ def get_parser():
     parser.add_argument('--loglevel', type=int, default=logging.DEBUG)
     parser.add_argument('--n_threads', type=int, default=mp.cpu_count())
 
-    parser.add_argument('--bcl_path', required=True)
+    parser.add_argument('--bcl_path', default=None)
     parser.add_argument('--output_dir', required=True)
 
+    # count from a decoded-cycle store (read_extraction.py --output_format
+    # store) instead of the CBCLs of --bcl_path
+    parser.add_argument('--store_dir', default=None)
+
     parser.add_argument('--index_cycle_start', required=True, type=int)
     parser.add_argument('--index_cycle_end', required=True, type=int)
 
+    parser.add_argument('--output_format', default='txt',
+                        choices=columnar.OUTPUT_FORMATS)
+
+    # dual-index mode: count i7/i5 pairs against a samplesheet instead
+    parser.add_argument('--samplesheet', default=None)
+    parser.add_argument('--i7_cycles', type=int, default=None)
+    parser.add_argument('--i5_rc', action='store_true')
+
+    parser.add_argument('--queue_depth', type=int, default=2)
+    parser.add_argument('--decode_threads', type=int, default=1)
+    parser.add_argument('--io_threads', type=int, default=1)
+
+    # e.g. 30GiB: caps the pool size and decodes tiles in chunks to fit
+    parser.add_argument('--max_memory', default=None)
+
+    # distinct reads a worker counts in memory (txt output) before spilling
+    # sorted counts to disk, to be merged when it's done
+    parser.add_argument('--max_counts', type=int, default=2**22)
+
+    # restrict to one shard of the run, see run_layout.py
+    parser.add_argument('--lane', type=int, default=None)
+    parser.add_argument('--part', type=int, default=None)
+    parser.add_argument('--tile_start', type=int, default=0)
+    parser.add_argument('--tile_end', type=int, default=None)
+
+    # skip the units already completed by an interrupted run
+    parser.add_argument('--resume', action='store_true')
+
+    parser.add_argument('--s3_endpoint_url', default=None)
+    parser.add_argument('--s3_cache_dir', default=storage.config['cache_dir'])
+    parser.add_argument('--s3_cache_size', default='32GiB')
+
     return parser
 
 
+def extract_unit(inputs, lane, i, nproc, store_dir, pipeline_opts):
+    # the chunks of a unit's tiles. inputs are the CBCL files to decode, or
+    # the cycles to read from a decoded-cycle store
+    if store_dir is None:
+        return bcl2fu.extract_tiles(inputs, cbcl_data[lane],
+                                    cbcl_filter_data[lane], i, nproc,
+                                    **pipeline_opts)
+    else:
+        return bcl2fu.extract_store_tiles(store_dir, lane, i, nproc, inputs,
+                                          pipeline_opts['chunk_clusters'])
+
+
 def read_count_processor(args):
-    cbcl_files, lane, i, nproc, n_tiles, out_file, log_queue = args
+    (unit, inputs, lane, i, nproc, n_tiles, out_file, output_format,
+     pipeline_opts, max_counts, store_dir, di, log_queue) = args
 
     try:
         msg = 'starting pooljob with args: ({}..., {}, {}, {}, {})'.format(
-                cbcl_files[0], lane, i, nproc, n_tiles
+                inputs[0], lane, i, nproc, n_tiles
         )
         log_queue.put((msg, logging.DEBUG))
 
-        read_counter = Counter(read for read in bcl2fu.extract_reads(
-                cbcl_files, lane, i, nproc, n_tiles
-        ))
+        if di is not None:
+            # one matrix per job, summed per lane in the main process. it's
+            # also saved so that a resumed run doesn't need to recount it
+            matrix = sum(index_hopping.pair_counts(byte_matrix, di)
+                         for tile, clusters, pf, byte_matrix in extract_unit(
+                                 inputs, lane, i, nproc, store_dir, pipeline_opts
+                         ))
+
+            with checkpoint.hashed_output(out_file) as OUT:
+                np.save(OUT, matrix)
+        elif output_format == 'txt':
+            # hidden, like the atomic_output temp files
+            spill_file = os.path.join(
+                    os.path.dirname(out_file),
+                    '.{}.{{}}.spill'.format(os.path.basename(out_file))
+            )
+            spill_files = []
+
+            def spill(counts):
+                spill_files.append(spill_file.format(len(spill_files)))
+                bcl2fu.spill_counts(counts, spill_files[-1])
+
+            try:
+                read_counter = Counter()
+                for tile, clusters, pf, byte_matrix in extract_unit(
+                        inputs, lane, i, nproc, store_dir, pipeline_opts
+                ):
+                    chunk_counts = bcl2fu.count_reads(byte_matrix)
+
+                    # spill before merging, so the counter never holds more
+                    # than max_counts reads. a chunk with more distinct reads
+                    # than that is spilled by itself
+                    if len(read_counter) + len(chunk_counts) > max_counts:
+                        if read_counter:
+                            spill(read_counter)
+                            read_counter.clear()
+
+                        if len(chunk_counts) > max_counts:
+                            spill(chunk_counts)
+                            continue
+
+                    read_counter.update(chunk_counts)
+
+                log_queue.put(('writing to {}'.format(out_file), logging.INFO))
+                with checkpoint.hashed_output(out_file) as OUT:
+                    with gzip.open(OUT, 'w') as GZ:
+                        for index, count in bcl2fu.merge_spilled_counts(
+                                read_counter, spill_files
+                        ):
+                            GZ.write('{}\t{}\n'.format(index, count).encode())
+            finally:
+                for fn in spill_files:
+                    if os.path.exists(fn):
+                        os.remove(fn)
+        else:
+            # counts are kept per tile, one row group each
+            schema = columnar.count_schema(len(inputs))
+
+            log_queue.put(('writing to {}'.format(out_file), logging.INFO))
+            with checkpoint.hashed_output(out_file) as OUT:
+                with columnar.batch_writer(OUT, schema,
+                                           output_format) as write:
+                    for tile, tile_chunks in itertools.groupby(
+                            extract_unit(inputs, lane, i, nproc, store_dir,
+                                         pipeline_opts),
+                            key=lambda tile_chunk: tile_chunk[0]
+                    ):
+                        keys, counts = columnar.merge_counts(
+                                columnar.count_keys(byte_matrix)
+                                for _, _, _, byte_matrix in tile_chunks
+                        )
+                        write(columnar.count_batch(schema, tile, keys, counts))
 
         msg = 'pooljob done for args: ({}..., {}, {}, {}, {})'.format(
-                cbcl_files[0], lane, i, nproc, n_tiles
+                inputs[0], lane, i, nproc, n_tiles
         )
         log_queue.put((msg, logging.DEBUG))
 
-        log_queue.put(('writing to {}'.format(out_file), logging.INFO))
-        with gzip.open(out_file, 'w') as OUT:
-            for index in read_counter:
-                OUT.write('{}\t{}\n'.format(index, read_counter[index]).encode())
+        return (unit, out_file, OUT.hexdigest(),
+                (lane, matrix) if di is not None else None)
     except Exception as detail:
         log_queue.put(("encountered exception in process:\n{}".format(detail),
                        logging.INFO))
@@ -70,46 +199,181 @@ def main(logger):
 
     args = parser.parse_args()
 
-    cbcl_file_lists, cbcl_filter_lists = cbcl_globber(args.bcl_path)
+    if (args.bcl_path is None) == (args.store_dir is None):
+        parser.error('one of --bcl_path or --store_dir is required')
+    # shards are (part, tile range) slices of a lane's CBCL headers, which a
+    # store doesn't keep. a store is split by --lane and --n_threads instead
+    if args.store_dir and (args.part is not None or args.tile_start != 0
+                           or args.tile_end is not None):
+        parser.error('a decoded-cycle store has no parts, --part, --tile_start'
+                     ' and --tile_end are for --bcl_path')
+
+    # bcl_path can be an s3:// url, in which case only the needed blocks are read
+    storage.configure(endpoint_url=args.s3_endpoint_url,
+                      cache_dir=args.s3_cache_dir,
+                      cache_max_bytes=bcl2fu.parse_size(args.s3_cache_size))
+
+    if args.samplesheet:
+        if args.i7_cycles is None:
+            parser.error('--i7_cycles is required with --samplesheet')
+
+        di = index_hopping.get_dual_index(
+                index_hopping.read_samplesheet_indexes(args.samplesheet,
+                                                       args.i5_rc),
+                args.i7_cycles
+        )
+
+        if (len(di.i7[0]) > args.i7_cycles
+            or len(di.i5[0]) > (args.index_cycle_end - args.index_cycle_start
+                                - args.i7_cycles)):
+            parser.error('samplesheet barcodes are longer than the index cycles')
 
-    in_range = lambda cfn: (args.index_cycle_start
-                            <= get_cycle(cfn)
-                            < args.index_cycle_end)
+        logger.info('counting pairs of {} i7 and {} i5 barcodes'.format(
+                len(di.i7), len(di.i5))
+        )
+    else:
+        di = None
+
+    if (di is None and args.output_format in ('arrow', 'parquet')
+        and (args.index_cycle_end - args.index_cycle_start
+             > bcl2fu.MAX_PACKED_CYCLES)):
+        parser.error('--output_format {} holds at most {} cycles'.format(
+            args.output_format, bcl2fu.MAX_PACKED_CYCLES)
+        )
 
-    cbcl_file_lists = {
-        (lane, part):tuple(cfn for cfn in cbcl_file_lists[lane, part]
-                           if in_range(cfn))
-        for lane,part in cbcl_file_lists
-    }
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    params = checkpoint.run_params(args, RUN_PARAMS)
+    if args.resume:
+        old_params, completed = checkpoint.read_manifest(args.output_dir)
+        if old_params is not None and old_params != params:
+            parser.error('--resume: {} was written with different arguments'.format(
+                    os.path.join(args.output_dir, checkpoint.MANIFEST_FILE))
+            )
+
+        completed = checkpoint.verify_outputs(args.output_dir, completed)
+        logger.info('resuming, {} units already complete'.format(len(completed)))
+    else:
+        completed = dict()
+
+    tile_range = (args.tile_start, args.tile_end)
+
+    if args.store_dir:
+        # lanes and tiles come from the store, each lane is a single part
+        lane_tiles = bcl2fu.store_lane_tiles(args.store_dir)
+        lane_parts = [(lane, 0) for lane in sorted(lane_tiles)
+                      if args.lane is None or lane == args.lane]
+        if not lane_parts:
+            parser.error('no tiles to count in {}'.format(args.store_dir))
+
+        cycles = tuple(range(args.index_cycle_start, args.index_cycle_end))
+        try:
+            bcl2fu.open_store_tile(args.store_dir, lane_parts[0][0],
+                                   lane_tiles[lane_parts[0][0]][0], cycles)
+        except ValueError as detail:
+            parser.error('--store_dir: {}'.format(detail))
+
+        unit_inputs = {lane_part: cycles for lane_part in lane_parts}
+        cbcl_number_of_tiles = [len(lane_tiles[lane])
+                                for lane, part in lane_parts]
+
+        logger.info('{} total tiles in {}'.format(
+                sum(cbcl_number_of_tiles), args.store_dir)
+        )
+    else:
+        discovery_start = time.time()
 
-    logger.info('{} CBCL files to read'.format(
-            sum(map(len, cbcl_file_lists.values())))
-    )
+        cbcl_file_lists, cbcl_filter_lists = bcl2fu.cbcl_globber(args.bcl_path)
 
-    global cbcl_data
-    global cbcl_filter_data
+        logger.info('found {} lane/parts and {} filter files in {:.1f}s'.format(
+                len(cbcl_file_lists), sum(map(len, cbcl_filter_lists.values())),
+                time.time() - discovery_start)
+        )
 
-    lane_parts = sorted(cbcl_file_lists)
+        in_range = lambda cfn: (args.index_cycle_start
+                                <= bcl2fu.get_cycle(cfn)
+                                < args.index_cycle_end)
 
-    cbcl_number_of_tiles = bcl2fu.get_cbcl_data(
-            cbcl_data, cbcl_file_lists, lane_parts, logger
-    )
+        in_shard = lambda lane, part: (
+                (args.lane is None or lane == args.lane)
+                and (args.part is None or part == args.part)
+        )
 
-    for lane in cbcl_filter_lists:
-        cbcl_filter_data[lane].update(
-                bcl2fu.read_cbcl_filters(cbcl_filter_lists[lane])
+        cbcl_file_lists = {
+            (lane, part):tuple(cfn for cfn in cbcl_file_lists[lane, part]
+                               if in_range(cfn))
+            for lane,part in cbcl_file_lists
+            if in_shard(lane, part)
+        }
+
+        logger.info('{} CBCL files to read'.format(
+                sum(map(len, cbcl_file_lists.values())))
         )
 
-    logger.info('{} total tiles'.format(sum(cbcl_number_of_tiles)))
+        global cbcl_data
+        global cbcl_filter_data
 
-    logger.debug('initializing pool of {} processes'.format(args.n_threads))
-    pool = mp.Pool(args.n_threads)
+        lane_parts = sorted(cbcl_file_lists)
 
-    logger.info('reading {} files and aggregating counters'.format(
-            sum(map(len, cbcl_file_lists.values()))
-    ))
+        cbcl_number_of_tiles = bcl2fu.get_cbcl_data(
+                cbcl_data, cbcl_file_lists, lane_parts, logger
+        )
 
-    output_file = os.path.join(args.output_dir, 'index_counts_{}.txt.gz')
+        cbcl_filter_lists = bcl2fu.shard_filter_lists(
+                    cbcl_filter_lists, cbcl_data, cbcl_file_lists, tile_range
+            )
+
+        for lane in cbcl_filter_lists:
+            cbcl_filter_data[lane].update(
+                    bcl2fu.read_lane_filters(cbcl_filter_lists[lane])
+            )
+
+        logger.info('{} total tiles, read headers and filters in {:.1f}s'.format(
+                sum(cbcl_number_of_tiles), time.time() - discovery_start)
+        )
+
+        unit_inputs = cbcl_file_lists
+
+    # only the txt output keeps a Counter of reads
+    max_counts = (args.max_counts if di is None and args.output_format == 'txt'
+                  else 0)
+
+    try:
+        if args.max_memory and args.store_dir:
+            n_procs, chunk_clusters = bcl2fu.plan_store_memory(
+                    bcl2fu.parse_size(args.max_memory), args.store_dir,
+                    len(cycles), args.n_threads, max_counts
+            )
+        elif args.max_memory:
+            n_procs, chunk_clusters = bcl2fu.plan_memory(
+                    bcl2fu.parse_size(args.max_memory), cbcl_data,
+                    cbcl_file_lists, cbcl_filter_data, args.n_threads,
+                    args.queue_depth, args.decode_threads, max_counts
+            )
+    except ValueError as detail:
+        parser.error('--max_memory: {}'.format(detail))
+
+    if args.max_memory:
+        logger.info('memory budget of {}: {} processes, {}'.format(
+                args.max_memory, n_procs,
+                'chunks of {} clusters'.format(chunk_clusters) if chunk_clusters
+                else 'whole tiles')
+        )
+    else:
+        n_procs, chunk_clusters = args.n_threads, None
+
+    pipeline_opts = {'queue_depth': args.queue_depth,
+                     'decode_threads': args.decode_threads,
+                     'io_threads': args.io_threads,
+                     'chunk_clusters': chunk_clusters,
+                     'tile_range': tile_range}
+
+    logger.debug('initializing pool of {} processes'.format(n_procs))
+    pool = mp.Pool(n_procs)
+
+    logger.info('reading {} tiles and aggregating counters'.format(
+            sum(cbcl_number_of_tiles)
+    ))
 
     log_queue, log_thread = ut_log.get_thread_logger(logger)
 
@@ -121,23 +385,100 @@ def main(logger):
         map(itertools.repeat, s, itertools.repeat(args.n_threads))
     )
 
+    if di is not None:
+        output_file = os.path.join(args.output_dir, 'pair_counts_{}.npy')
+        output_files = map(output_file.format, itertools.count())
+    elif args.output_format == 'txt':
+        output_file = os.path.join(args.output_dir, 'index_counts_{}.txt.gz')
+        output_files = map(output_file.format, itertools.count())
+    else:
+        output_files = (
+            columnar.output_path(args.output_dir, lane,
+                                 'index_counts_{}'.format(n), args.output_format)
+            for n, (lane, part) in enumerate(rep_n(lane_parts))
+        )
+
+    # one unit of work per job, the same every time for the same arguments
+    units = [(lane, part) + tile_range + (i, args.n_threads)
+             for (lane, part), i in zip(rep_n(lane_parts),
+                                        itertools.cycle(range(args.n_threads)))]
+
+    jobs = [
+        job for job in zip(
+                units,
+                rep_n(unit_inputs[lane, part] for lane,part in lane_parts),
+                rep_n(lane for lane, part in lane_parts),
+                itertools.cycle(range(args.n_threads)),
+                itertools.repeat(args.n_threads),
+                rep_n(cbcl_number_of_tiles),
+                output_files,
+                itertools.repeat(args.output_format),
+                itertools.repeat(pipeline_opts),
+                itertools.repeat(args.max_counts),
+                itertools.repeat(args.store_dir),
+                itertools.repeat(di),
+                itertools.repeat(log_queue)
+        )
+        if checkpoint.unit_key(job[0]) not in completed
+    ]
+    logger.info('{} of {} units to run'.format(len(jobs), len(units)))
+
+    lane_matrices = dict()
+
+    # pair counts of the units that were already done
+    if di is not None:
+        for key, (out_file, md5) in completed.items():
+            lane = int(key.split('\t')[0])
+            lane_matrices[lane] = lane_matrices.get(lane, 0) + np.load(
+                    os.path.join(args.output_dir, out_file)
+            )
+
+    manifest = checkpoint.open_manifest(args.output_dir, params, completed)
+
     # using imap_unordered to (maybe) keep memory usage low in the main thread
+    n_done = 0
     try:
-        pool.imap_unordered(
-                read_count_processor,
-                zip(
-                        rep_n(cbcl_file_lists[lane, part] for lane,part in lane_parts),
-                        rep_n(lane for lane, part in lane_parts),
-                        itertools.cycle(range(args.n_threads)),
-                        itertools.repeat(args.n_threads),
-                        rep_n(cbcl_number_of_tiles),
-                        map(output_file.format, itertools.count()),
-                        itertools.repeat(log_queue)
-                )
-        )
+        for result in pool.imap_unordered(read_count_processor, jobs):
+            if result is not None:
+                unit, out_file, md5, lane_matrix = result
+                checkpoint.record_unit(manifest, args.output_dir,
+                                       unit, out_file, md5)
+                n_done += 1
+
+                if lane_matrix is not None:
+                    lane, matrix = lane_matrix
+                    lane_matrices[lane] = lane_matrices.get(lane, 0) + matrix
     finally:
         pool.close()
         pool.join()
+        manifest.close()
+
+    if n_done < len(jobs):
+        logger.warning('{} units failed, rerun with --resume to redo them'.format(
+                len(jobs) - n_done)
+        )
+
+    if di is not None:
+        reports = []
+        for lane in sorted(lane_matrices):
+            index_hopping.write_pair_matrix(
+                    os.path.join(args.output_dir,
+                                 'pair_counts_L{:03d}.txt.gz'.format(lane)),
+                    lane_matrices[lane], di
+            )
+            reports.append(index_hopping.hopping_report(
+                    lane, lane_matrices[lane], di
+            ))
+
+            logger.info('lane {}: {:.4%} index hopping'.format(
+                    lane, reports[-1][0][-1])
+            )
+
+        index_hopping.write_hopping_report(
+                os.path.join(args.output_dir, 'index_hopping.txt'),
+                os.path.join(args.output_dir, 'unexpected_pairs.txt'),
+                reports
+        )
 
     log_queue.put('STOP')
     log_thread.join()
@@ -1,16 +1,25 @@
 #!/usr/bin/env python
 
 import glob
-import gzip
+import hashlib
+import heapq
 import io
 import itertools
 import os
+import queue
+import re
+import shutil
 import struct
+import threading
+import zlib
 
 from collections import defaultdict, namedtuple, Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
+import seqbot.demuxer.storage as storage
+
 
 cbcl_info = namedtuple('CBCL', ('version', 'header_size', 'bits_per_basecall',
                                 'bits_per_qscore', 'num_bins', 'bins',
@@ -18,79 +27,119 @@ cbcl_info = namedtuple('CBCL', ('version', 'header_size', 'bits_per_basecall',
                                 'non_PF_clusters_excluded'))
 
 get_cycle = lambda cfn: int(os.path.basename(os.path.dirname(cfn))[1:-2])
-get_part = lambda cfn: int(os.path.basename(cfn)[2])
-get_tile = lambda cfn: int(os.path.basename(cfn)[4:8])
+get_part = lambda cfn: int(os.path.basename(cfn)[:-len('.cbcl')].split('_')[1])
+get_tile = lambda cfn: int(os.path.basename(cfn)[:-len('.filter')].split('_')[2])
+
+# run folder layout: BaseCalls/L{lane:03d}/C{cycle}.1/L{lane:03d}_{part}.cbcl
+# and BaseCalls/L{lane:03d}/s_{lane}_{tile}.filter
+lane_dir_re = re.compile(r'L\d{3}$')
+cycle_dir_re = re.compile(r'C\d+\.1$')
+cbcl_file_re = re.compile(r'L\d{3}_\d+\.cbcl$')
+filter_file_re = re.compile(r's_\d+_\d+\.filter$')
+
+# headers and filters are small reads, mostly waiting on the filesystem (or
+# S3), so they're read on a thread pool
+DISCOVERY_THREADS = 16
+
+# a tile of the decoded-cycle store, see open_store_tile
+store_tile = namedtuple('store_tile', ('lane', 'tile', 'cycles', 'clusters',
+                                       'bases', 'n_mask'))
+
+# marks the end of a prefetched stream
+_done = object()
+
+def read_cbcl_header(cbcl_file):
+    header_size = struct.unpack('<I', storage.read_range(cbcl_file, 2, 4))[0]
+
+    with io.BytesIO(storage.read_range(cbcl_file, 0, header_size)) as f:
+        version, header_size, bits_per_basecall, bits_per_qscore, num_bins = struct.unpack(
+            '<HIBBI', f.read(12))
+        bins = np.frombuffer(
+                f.read(4*2*num_bins), dtype=np.uint32, count=2*num_bins
+        ).reshape((num_bins, 2))
+
+        num_tiles = struct.unpack('<I', f.read(4))[0]
+        # Each row in tiles comprises the tile number, num clusters in block, uncompressed block size, and compressed block size of the tile. 
+        tiles = np.frombuffer(
+            f.read(4*4*num_tiles), dtype=np.uint32, count=4*num_tiles
+        ).reshape((num_tiles, 4))
+
+        non_PF_clusters_excluded = bool(struct.unpack('B', f.read(1))[0])
 
-def read_cbcl_headers(cbcl_files):
-    cbcl_headers = dict()
+    return cbcl_info(version,
+                     header_size,
+                     bits_per_basecall,
+                     bits_per_qscore,
+                     num_bins,
+                     bins,
+                     num_tiles,
+                     tiles,
+                     non_PF_clusters_excluded)
 
-    for cbcl_file in cbcl_files:
-        with open(cbcl_file, 'rb') as f:
-            version, header_size, bits_per_basecall, bits_per_qscore, num_bins = struct.unpack(
-                '<HIBBI', f.read(12))
-            bins = np.fromfile(
-                    f, dtype=np.uint32, count=2*num_bins
-            ).reshape((num_bins, 2))
 
-            num_tiles = struct.unpack('<I', f.read(4))[0]
-            # Each row in tiles comprises the tile number, num clusters in block, uncompressed block size, and compressed block size of the tile. 
-            tiles = np.fromfile(
-                f, dtype=np.uint32, count=4*num_tiles
-            ).reshape((num_tiles, 4))
+def read_cbcl_headers(cbcl_files, threads=DISCOVERY_THREADS):
+    with ThreadPoolExecutor(threads) as executor:
+        return dict(zip(cbcl_files, executor.map(read_cbcl_header, cbcl_files)))
 
-            non_PF_clusters_excluded = bool(struct.unpack('B', f.read(1))[0])
 
-            cbcl_file_data[fn] = cbcl_info(version,
-                                           header_size,
-                                           bits_per_basecall,
-                                           bits_per_qscore,
-                                           num_bins,
-                                           bins,
-                                           num_tiles,
-                                           tiles,
-                                           non_PF_clusters_excluded)
+def read_tile_filter(tile_filter):
+    tile_filter_data = storage.read_range(tile_filter)
 
-    return cbcl_file_data
+    zv, filter_version, num_clusters = struct.unpack_from('III', tile_filter_data)
+    pf = np.frombuffer(tile_filter_data, dtype=np.uint8, count=num_clusters,
+                       offset=12)
 
+    return (pf & 0b1).astype(bool)
 
-def read_lane_filters(lane_filters):
-    lane_filters = dict()
 
-    for tile_filter in lane_filters:
-        with open(tile_filter, 'rb') as f:
-            zv, filter_version, num_clusters = struct.unpack('III', f.read(12))
-            pf = np.fromfile(f, dtype=np.uint8, count=num_clusters)
+def read_lane_filters(lane_filter_files, threads=DISCOVERY_THREADS):
+    with ThreadPoolExecutor(threads) as executor:
+        return dict(zip(map(get_tile, lane_filter_files),
+                        executor.map(read_tile_filter, lane_filter_files)))
 
-            lane_filters[get_tile(tile_filter)] = (pf & 0b1).astype(bool)
 
-    return lane_filters
+def scan_lane(lane_dir):
+    # one pass over a lane directory: {part: cbcl files} and the filter files
+    cbcl_files = defaultdict(list)
+    filter_files = []
 
+    for path in storage.walk_files(lane_dir):
+        name = os.path.basename(path)
 
-def cbcl_globber(bcl_path):
+        if (cbcl_file_re.match(name)
+            and cycle_dir_re.match(os.path.basename(os.path.dirname(path)))):
+            cbcl_files[get_part(path)].append(path)
+        elif filter_file_re.match(name):
+            filter_files.append(path)
+
+    return cbcl_files, filter_files
+
+
+def cbcl_globber(bcl_path, threads=DISCOVERY_THREADS):
+    # lists each lane directory once (concurrently) instead of globbing every
+    # cycle directory per part. returns {(lane, part): cbcl files by cycle}
+    # and {lane: filter files by tile}
     cbcl_file_lists = dict()
     cbcl_filter_lists = dict()
 
-    for lane in (1, 2, 3, 4):
-        for part in itertools.count(1):
-            cbcl_files = glob.glob(
-                    os.path.join(bcl_path, 'Data', 'Intensities', 'BaseCalls',
-                                 'L00{}'.format(lane), 'C*.1',
-                                 'L00{}_{}.cbcl'.format(lane, part))
-            )
-            if cbcl_files:
-                cbcl_files.sort(key=get_cycle)
-                cbcl_file_lists[lane, part] = cbcl_files
-            else:
-                break
-
-        cbcl_filter_list = glob.glob(
-                os.path.join(bcl_path, 'Data', 'Intensities', 'BaseCalls',
-                             'L00{}'.format(lane),
-                             's_{}_*.filter'.format(lane))
+    basecalls_dir = os.path.join(bcl_path, 'Data', 'Intensities', 'BaseCalls')
+    lanes = [int(name[1:]) for name in storage.list_dir(basecalls_dir)
+             if lane_dir_re.match(name)]
+
+    with ThreadPoolExecutor(threads) as executor:
+        lane_scans = executor.map(
+                lambda lane: scan_lane(
+                        os.path.join(basecalls_dir, 'L{:03d}'.format(lane))
+                ),
+                lanes
         )
 
-        cbcl_filter_list.sort(key=get_tile)
-        cbcl_filter_lists[lane] = cbcl_filter_list
+        for lane, (cbcl_files, filter_files) in zip(lanes, lane_scans):
+            for part in cbcl_files:
+                cbcl_file_lists[lane, part] = sorted(cbcl_files[part],
+                                                     key=get_cycle)
+
+            cbcl_filter_lists[lane] = sorted(filter_files, key=get_tile)
 
     return cbcl_file_lists, cbcl_filter_lists
 
@@ -98,15 +147,21 @@ def cbcl_globber(bcl_path):
 def get_cbcl_data(cbcl_data, cbcl_file_lists, lane_parts, logger):
     cbcl_number_of_tiles = list()
 
+    logger.info('reading headers for {} files'.format(
+            sum(len(cbcl_file_lists[lane_part]) for lane_part in lane_parts))
+    )
+
+    # all the headers at once, so the thread pool stays busy
+    cbcl_headers = read_cbcl_headers([fn for lane_part in lane_parts
+                                      for fn in cbcl_file_lists[lane_part]])
+
     for lane,part in lane_parts:
-        logger.info('reading headers for {} files'.format(
-                len(cbcl_file_lists[lane, part]))
-        )
         logger.debug('\n\t{}'.format('\n\t'.join(cbcl_file_lists[lane, part])))
 
-        cbcl_data[lane].update(read_cbcl_data(cbcl_file_lists[lane, part]))
+        cbcl_data[lane].update((fn, cbcl_headers[fn])
+                               for fn in cbcl_file_lists[lane, part])
 
-        number_of_tiles = {cbcl_data[lane][fn].number_of_tile_records
+        number_of_tiles = {cbcl_data[lane][fn].num_tiles
                            for fn in cbcl_file_lists[lane, part]}
 
         assert len(number_of_tiles) == 1
@@ -118,48 +173,626 @@ def get_cbcl_data(cbcl_data, cbcl_file_lists, lane_parts, logger):
     return cbcl_number_of_tiles
 
 
-def get_byte_lists(cbcl_files, lane, tile_i):
-    for fn in cbcl_files:
-        ci = cbcl_data[lane][fn]
-        cf = cbcl_filter_data[lane][ci.tile_offsets[tile_i, 0]]
+def shard_filter_lists(cbcl_filter_lists, cbcl_data, cbcl_file_lists,
+                       tile_range=(0, None)):
+    # only the filter files for tiles that will be read, so a shard doesn't
+    # load the filters for the whole run
+    tiles = defaultdict(set)
+    for (lane, part), cbcl_files in cbcl_file_lists.items():
+        ci = cbcl_data[lane][cbcl_files[0]]
+        tiles[lane].update(ci.tiles[slice(*tile_range), 0].tolist())
 
-        with open(fn, 'rb') as f:
-            f.seek(ci.header_size + ci.tile_offsets[:tile_i, 3].sum(dtype=int))
+    return {lane: [fn for fn in cbcl_filter_lists[lane]
+                   if get_tile(fn) in tiles[lane]]
+            for lane in tiles}
 
-            tile_data = io.BytesIO(f.read(ci.tile_offsets[tile_i, 3]))
-            try:
-                g = gzip.GzipFile(fileobj=tile_data, mode='r').read()
-                byte_array = np.frombuffer(g, dtype=np.uint8,
-                                           count=ci.tile_offsets[tile_i, 2])
-            except OSError:
-                yield None
-                continue
-
-            if ci.non_PF_clusters_excluded and cf.sum() % 2:
-                yield np.hstack(
-                        ((byte_array & 0b11)[:-1], (byte_array >> 4 & 0b11))
-                )
-            elif ci.non_PF_clusters_excluded:
-                yield np.hstack(
-                        ((byte_array & 0b11), (byte_array >> 4 & 0b11))
-                )
-            else:
-                yield np.hstack(((byte_array & 0b11)[cf[::2]],
-                                 (byte_array >> 4 & 0b11)[cf[1::2]]))
 
+def unpack_nibbles(byte_array, num_clusters):
+    # each byte holds two clusters, low nibble first
+    nibbles = np.empty(2 * byte_array.shape[0], dtype=np.uint8)
+    nibbles[0::2] = byte_array & 0b1111
+    nibbles[1::2] = byte_array >> 4
+
+    return nibbles[:num_clusters]
+
+
+def decode_basecalls(byte_array, num_clusters):
+    # each nibble is two bits of basecall followed by two bits of qscore bin,
+    # and bin 0 is a no-call
+    nibbles = unpack_nibbles(byte_array, num_clusters)
+
+    bases = nibbles & 0b11
+    bases[(nibbles >> 2) == 0] = 4
+
+    return bases
+
+
+def decode_qscores(byte_array, num_clusters, ci):
+    # maps the qscore bins to the quality scores listed in the header
+    qscores = np.zeros(2**ci.bits_per_qscore, dtype=np.uint8)
+    qscores[ci.bins[:, 0]] = ci.bins[:, 1]
+
+    return qscores[unpack_nibbles(byte_array, num_clusters) >> 2]
+
+
+def stored_clusters(ci, cf):
+    # cluster ids (row numbers in the filter file) stored in a tile block
+    if ci.non_PF_clusters_excluded:
+        return np.flatnonzero(cf)
+    else:
+        return np.arange(cf.shape[0])
+
+
+def tile_chunks(num_clusters, chunk_clusters=None):
+    # (start, stop) ranges over the clusters stored in a block. chunks are an
+    # even number of clusters so that each one starts on a byte boundary
+    if chunk_clusters is None or chunk_clusters >= num_clusters:
+        return [(0, num_clusters)]
+
+    chunk_clusters = max(2, chunk_clusters - chunk_clusters % 2)
 
-def extract_reads(cbcl_files, lane, i, nproc, n_tiles):
-    for ii in range(i, n_tiles, nproc):
-        ba_generator = enumerate(get_byte_lists(cbcl_files, lane, ii))
-        j, byte_array = next(ba_generator)
+    return [(a, min(a + chunk_clusters, num_clusters))
+            for a in range(0, num_clusters, chunk_clusters)]
 
-        byte_matrix = 4 * np.ones((byte_array.shape[0], len(cbcl_files)),
-                                  dtype=np.uint8)
-        byte_matrix[:, j] = byte_array
 
-        for j, byte_array in ba_generator:
-            if byte_array is not None:
-                byte_matrix[:, j] = byte_array
+def read_tile_block(fn, ci, tile_i):
+    offset = ci.header_size + int(ci.tiles[:tile_i, 3].sum(dtype=int))
+    return storage.read_range(fn, offset, int(ci.tiles[tile_i, 3]))
 
+
+def decode_block_chunks(ci, cf, block, chunks, pf_only=True):
+    # inflates a tile block and yields the decoded basecalls for each chunk of
+    # stored clusters, so the whole tile is never unpacked at once. the block
+    # is inflated in one go so that its gzip CRC is checked before anything is
+    # yielded: if it's corrupt, every chunk is None
+    try:
+        data = np.frombuffer(zlib.decompress(block, wbits=31), dtype=np.uint8)
+    except zlib.error:
+        data = None
+
+    if data is not None and data.shape[0] < (chunks[-1][1] + 1) // 2:
+        data = None
+
+    for a, b in chunks:
+        if data is None:
+            yield None
+            continue
+
+        # chunks start on an even cluster, i.e. a byte boundary
+        bases = decode_basecalls(data[a // 2:(b + 1) // 2], b - a)
+
+        if pf_only and not ci.non_PF_clusters_excluded:
+            yield bases[cf[a:b]]
+        else:
+            yield bases
+
+
+def prefetch(iterable, depth):
+    # iterate over iterable on a background thread, staying at most depth
+    # items ahead of the consumer. exceptions are re-raised in the consumer,
+    # and closing this generator early stops (and closes) the producer
+    item_queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                item_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_done, None))
+        except Exception as detail:
+            put((_done, detail))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, detail = item_queue.get()
+            if item is _done:
+                if detail is not None:
+                    raise detail
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def extract_tiles(cbcl_files, cbcl_data, cbcl_filters, i, nproc, pf_only=True,
+                  queue_depth=2, decode_threads=1, io_threads=1,
+                  chunk_clusters=None, tile_range=(0, None)):
+    # three stages connected by bounded queues: I/O threads read the
+    # compressed blocks for upcoming tiles, a thread pool inflates and decodes
+    # them (zlib releases the GIL), and the caller formats and writes. at most
+    # queue_depth tiles (or chunks) are buffered between each pair of stages.
+    # more io_threads mostly helps when reading from S3, where each block is a
+    # separate ranged GET.
+    # with chunk_clusters set, tiles are decoded and yielded in chunks of at
+    # most that many clusters, so a tile can yield several times.
+    # tile_range restricts this to a (start, stop) slice of the tiles in
+    # cbcl_files, when a run is sharded over several jobs
+    ci = cbcl_data[cbcl_files[0]]
+    tile_is = range(ci.num_tiles)[slice(*tile_range)][i::nproc]
+
+    io_executor = ThreadPoolExecutor(io_threads)
+    decode_executor = ThreadPoolExecutor(decode_threads)
+
+    compressed_tiles = prefetch(
+            ((ii, list(io_executor.map(
+                    lambda fn: read_tile_block(fn, cbcl_data[fn], ii), cbcl_files
+              )))
+             for ii in tile_is),
+            queue_depth
+    )
+
+    def decode_tiles():
+        for ii, blocks in compressed_tiles:
+            tile = ci.tiles[ii, 0]
+            cf = cbcl_filters[tile]
+            tile_clusters = stored_clusters(ci, cf)
+            chunks = tile_chunks(tile_clusters.shape[0], chunk_clusters)
+
+            block_chunks = [
+                decode_block_chunks(cbcl_data[fn], cf, block, chunks, pf_only)
+                for fn, block in zip(cbcl_files, blocks)
+            ]
+
+            for a, b in chunks:
+                clusters = tile_clusters[a:b]
+                if pf_only:
+                    clusters = clusters[cf[clusters]]
+
+                # unreadable blocks are left as no-calls
+                byte_matrix = np.full((clusters.shape[0], len(cbcl_files)), 4,
+                                      dtype=np.uint8)
+
+                for j, byte_array in enumerate(
+                        decode_executor.map(next, block_chunks)):
+                    if byte_array is not None:
+                        byte_matrix[:, j] = byte_array
+
+                yield tile, clusters, cf[clusters], byte_matrix
+
+    try:
+        yield from prefetch(decode_tiles(), queue_depth)
+    finally:
+        compressed_tiles.close()
+        io_executor.shutdown()
+        decode_executor.shutdown()
+
+
+def extract_reads(cbcl_files, cbcl_data, cbcl_filters, i, nproc, **pipeline_opts):
+    for tile, clusters, pf, byte_matrix in extract_tiles(
+            cbcl_files, cbcl_data, cbcl_filters, i, nproc, **pipeline_opts):
         yield from (''.join('ACGTN'[b] for b in byte_matrix[k, :])
                     for k in range(byte_matrix.shape[0]))
+
+
+def count_reads(byte_matrix):
+    # {read: count} for one tile or chunk, counting distinct rows in numpy
+    # first so that callers only touch each distinct read once
+    reads, counts = np.unique(byte_matrix, axis=0, return_counts=True)
+
+    return {''.join('ACGTN'[b] for b in read): int(count)
+            for read, count in zip(reads, counts)}
+
+
+# rough size of one entry of a Counter of reads, besides the read's characters:
+# the str and int objects and the dict slot, plus the (read, count) tuple and
+# list slot made when it's sorted to be spilled
+COUNT_ENTRY_OVERHEAD = 200
+
+
+def spill_counts(read_counter, spill_file):
+    # writes the counts sorted by read, so that spills can be merged in order
+    with open(spill_file, 'w') as OUT:
+        for read, count in sorted(read_counter.items()):
+            OUT.write('{}\t{}\n'.format(read, count))
+
+
+def merge_sorted_counts(count_streams):
+    # merges iterables of (read, count) that are each sorted by read, yielding
+    # each read once, in order, with its total count
+    merged = heapq.merge(*count_streams)
+
+    for read, read_counts in itertools.groupby(merged, key=lambda rc: rc[0]):
+        yield read, sum(count for _, count in read_counts)
+
+
+def merge_spilled_counts(read_counter, spill_files):
+    # yields (read, count) in sorted order, summing the counter in memory and
+    # the spilled ones
+    def read_spill(spill_file):
+        with open(spill_file) as f:
+            for line in f:
+                read, count = line.split('\t')
+                yield read, int(count)
+
+    return merge_sorted_counts([sorted(read_counter.items())]
+                               + list(map(read_spill, spill_files)))
+
+
+# rough fixed costs (interpreter, numpy, pyarrow, buffers) for the main
+# process and for each pool process
+MAIN_OVERHEAD = 512 * 2**20
+WORKER_OVERHEAD = 192 * 2**20
+
+# smallest chunk worth decoding, below this we'd rather run fewer workers
+MIN_CHUNK_CLUSTERS = 2**16
+
+
+def parse_size(size):
+    # '32G', '30GiB', '512m' or a plain number of bytes
+    m = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?\s*', size.lower())
+    if m is None:
+        raise ValueError('could not parse memory size: {}'.format(size))
+
+    return int(float(m.group(1)) * 2**(10 * ' kmgt'.index(m.group(2) or ' ')))
+
+
+def count_memory(n_cycles, max_counts):
+    # (bytes per worker, bytes per cluster of a chunk) to count reads into a
+    # Counter of at most max_counts distinct reads, as barcode_count.py does
+    # for txt output: the Counter itself, and for each chunk np.unique's
+    # sorted copy and index arrays in count_reads plus the dict it returns,
+    # which can hold a distinct read for every cluster. nothing if max_counts
+    # is 0
+    if not max_counts:
+        return 0, 0
+
+    entry = COUNT_ENTRY_OVERHEAD + n_cycles
+
+    return max_counts * entry, 3 * n_cycles + 24 + entry
+
+
+def plan_memory(max_memory, cbcl_data, cbcl_file_lists, cbcl_filter_data,
+                n_procs, queue_depth=2, decode_threads=1, max_counts=0,
+                store_output=False):
+    # picks (number of pool processes, chunk_clusters) so that the whole job
+    # stays within max_memory bytes, using the cluster counts and block sizes
+    # in the headers. per process we hold:
+    #   - up to queue_depth + 2 tiles of compressed blocks (queued, decoding)
+    #   - the inflated blocks of the tile being decoded, half a byte per
+    #     cluster per cycle (they're inflated whole to check the gzip CRC)
+    #   - up to queue_depth + 2 chunk matrices of n_cycles bytes per cluster
+    #   - a few bytes per cluster per decode thread for inflating and unpacking
+    #   - packed/formatted output for the chunk being written
+    #   - for barcode_count.py txt output, the memory of count_memory
+    #   - for store output, a few more copies of the chunk while it's packed
+    #     (the store arrays themselves are memory-mapped files)
+    # the filters are loaded once in the main process and shared by fork.
+    # chunks shrink before workers are dropped, down to MIN_CHUNK_CLUSTERS
+    n_cycles = max(map(len, cbcl_file_lists.values()))
+    max_clusters = max(int(ci.tiles[:, 1].max())
+                       for lane in cbcl_data for ci in cbcl_data[lane].values())
+    max_compressed = max(
+            int(sum(cbcl_data[lane][fn].tiles[:, 3] for fn in cbcl_files).max())
+            for (lane, part), cbcl_files in cbcl_file_lists.items()
+    )
+
+    shared = sum(cf.nbytes for lane in cbcl_filter_data
+                 for cf in cbcl_filter_data[lane].values())
+
+    count_worker, count_cluster = count_memory(n_cycles, max_counts)
+
+    per_worker = (WORKER_OVERHEAD + (queue_depth + 2) * max_compressed
+                  + n_cycles * ((max_clusters + 1) // 2) + count_worker)
+    per_cluster = (n_cycles * (queue_depth + 2) + 3 * decode_threads + 32
+                   + count_cluster)
+    if store_output:
+        per_cluster += 3 * n_cycles
+
+    return fit_memory(max_memory, shared, per_worker, per_cluster, max_clusters,
+                      n_procs)
+
+
+def plan_store_memory(max_memory, store_dir, n_cycles, n_procs, max_counts=0):
+    # plan_memory for reading a decoded-cycle store. the tiles are memory-
+    # mapped, and each chunk is unpacked on the calling thread, holding the
+    # unpacked cycles and the byte matrix, plus count_memory as in plan_memory
+    max_clusters = max(
+            open_store_tile(store_dir, lane, tile).clusters.shape[0]
+            for lane, tiles in store_lane_tiles(store_dir).items()
+            for tile in tiles
+    )
+
+    count_worker, count_cluster = count_memory(n_cycles, max_counts)
+
+    per_worker = WORKER_OVERHEAD + count_worker
+    per_cluster = 3 * n_cycles + 32 + count_cluster
+
+    return fit_memory(max_memory, 0, per_worker, per_cluster, max_clusters,
+                      n_procs)
+
+
+def fit_memory(max_memory, shared, per_worker, per_cluster, max_clusters,
+               n_procs):
+    # (number of pool processes, chunk_clusters) that fit in max_memory, given
+    # the bytes shared through fork, and the bytes per worker and per cluster
+    # of a chunk. chunk_clusters is None if whole tiles fit
+    available = max_memory - MAIN_OVERHEAD - shared
+    min_chunk = min(MIN_CHUNK_CLUSTERS, max_clusters)
+
+    n_procs = min(n_procs, available // (per_worker + per_cluster * min_chunk))
+    if n_procs < 1:
+        raise ValueError(
+                'max_memory of {} bytes is too small, need at least {}'.format(
+                        max_memory, max_memory - available + per_worker
+                                    + per_cluster * min_chunk)
+        )
+
+    chunk_clusters = (available // n_procs - per_worker) // per_cluster
+
+    if chunk_clusters >= max_clusters:
+        return n_procs, None
+    else:
+        return n_procs, chunk_clusters
+
+
+# cycles that fit in the uint64 barcode column of the columnar output
+MAX_PACKED_CYCLES = 32
+
+
+def pack_bases(byte_matrix):
+    # packs up to 32 cycles of 2-bit basecalls into a uint64 per cluster, with
+    # the first cycle in the highest bits. no-calls are packed as A and flagged
+    # in a separate uint32 mask using the same cycle order
+    n_clusters, n_cycles = byte_matrix.shape
+    if n_cycles > MAX_PACKED_CYCLES:
+        raise ValueError('can only pack {} cycles, got {}'.format(
+            MAX_PACKED_CYCLES, n_cycles)
+        )
+
+    packed = np.zeros(n_clusters, dtype=np.uint64)
+    n_mask = np.zeros(n_clusters, dtype=np.uint32)
+
+    for j in range(n_cycles):
+        packed <<= np.uint64(2)
+        packed |= byte_matrix[:, j] & 0b11
+        n_mask <<= np.uint32(1)
+        n_mask |= byte_matrix[:, j] == 4
+
+    return packed, n_mask
+
+
+def unpack_bases(packed, n_mask, n_cycles):
+    shifts = np.arange(n_cycles - 1, -1, -1, dtype=np.uint64)
+
+    byte_matrix = ((packed[:, None] >> (2 * shifts)) & 0b11).astype(np.uint8)
+    byte_matrix[((n_mask[:, None] >> shifts.astype(np.uint32)) & 0b1) == 1] = 4
+
+    return byte_matrix
+
+
+# decoded-cycle store: selected cycles of a run, decoded once and kept PF
+# filtered and 2-bit packed, so later passes don't inflate the CBCLs again.
+# each tile is a directory lane={lane}/tile={tile}/ of .npy files that are
+# memory-mapped on read:
+#   cycles.npy    cycle numbers, uint16
+#   clusters.npy  PF cluster ids (rows in the filter file), uint32
+#   bases.npy     (cycles x clusters/4) uint8, see pack_cycles
+#   n_mask.npy    (cycles x clusters/8) uint8, no-call flags
+# the layout is cycle-major, so a range of cycles is a zero-copy view
+
+
+def pack_cycles(byte_matrix):
+    # four clusters per byte for each cycle, first cluster in the low bits.
+    # no-calls are packed as A and flagged in a bit-packed mask
+    n_clusters, n_cycles = byte_matrix.shape
+
+    bases = np.zeros((n_cycles, -(-n_clusters // 4) * 4), dtype=np.uint8)
+    bases[:, :n_clusters] = byte_matrix.T & 0b11
+
+    packed = (bases[:, 0::4] | (bases[:, 1::4] << 2)
+              | (bases[:, 2::4] << 4) | (bases[:, 3::4] << 6))
+    n_mask = np.packbits(byte_matrix.T == 4, axis=1, bitorder='little')
+
+    return packed, n_mask
+
+
+def unpack_cycles(packed, n_mask, n_clusters):
+    # back to a (clusters x cycles) byte matrix, as yielded by extract_tiles
+    bases = np.empty((packed.shape[0], packed.shape[1] * 4), dtype=np.uint8)
+    for k in range(4):
+        bases[:, k::4] = (packed >> (2 * k)) & 0b11
+
+    bases = bases[:, :n_clusters]
+    bases[np.unpackbits(n_mask, axis=1, count=n_clusters,
+                        bitorder='little').astype(bool)] = 4
+
+    return np.ascontiguousarray(bases.T)
+
+
+STORE_FILES = ('cycles', 'clusters', 'bases', 'n_mask')
+
+
+def write_store_tile(lane_dir, tile, cycles, n_clusters, chunks):
+    # writes a tile of n_clusters PF clusters from (clusters, byte_matrix)
+    # chunks as they're decoded, so the whole tile is never in memory, and
+    # returns its directory. the arrays are memory-mapped in a hidden
+    # directory that is renamed into place at the end, so a tile is either
+    # complete or missing. up to 7 clusters are carried between chunks, so
+    # each write starts on a byte of n_mask
+    tile_dir = os.path.join(lane_dir, 'tile={}'.format(tile))
+    tmp_dir = os.path.join(lane_dir, '.tile={}.tmp'.format(tile))
+
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    try:
+        np.save(os.path.join(tmp_dir, 'cycles.npy'),
+                np.asarray(cycles, dtype=np.uint16))
+
+        open_out = lambda name, shape: np.lib.format.open_memmap(
+                os.path.join(tmp_dir, name + '.npy'), mode='w+',
+                dtype=np.uint32 if name == 'clusters' else np.uint8, shape=shape
+        )
+        clusters_out = open_out('clusters', (n_clusters,))
+        bases_out = open_out('bases', (len(cycles), -(-n_clusters // 4)))
+        n_mask_out = open_out('n_mask', (len(cycles), -(-n_clusters // 8)))
+
+        def write(start, clusters, byte_matrix):
+            if start + clusters.shape[0] > n_clusters:
+                raise ValueError('tile {} has more than {} clusters'.format(
+                        tile, n_clusters)
+                )
+
+            packed, n_mask = pack_cycles(byte_matrix)
+            clusters_out[start:start + clusters.shape[0]] = clusters
+            bases_out[:, start // 4:start // 4 + packed.shape[1]] = packed
+            n_mask_out[:, start // 8:start // 8 + n_mask.shape[1]] = n_mask
+
+        start = 0
+        carry_clusters = np.zeros(0, dtype=np.uint32)
+        carry_matrix = np.zeros((0, len(cycles)), dtype=np.uint8)
+
+        for clusters, byte_matrix in chunks:
+            clusters = np.concatenate([carry_clusters, clusters])
+            byte_matrix = np.concatenate([carry_matrix, byte_matrix])
+
+            n = clusters.shape[0] - clusters.shape[0] % 8
+            write(start, clusters[:n], byte_matrix[:n])
+            start += n
+
+            carry_clusters, carry_matrix = clusters[n:], byte_matrix[n:]
+
+        write(start, carry_clusters, carry_matrix)
+        start += carry_clusters.shape[0]
+
+        if start != n_clusters:
+            raise ValueError('tile {} has {} clusters, expected {}'.format(
+                    tile, start, n_clusters)
+            )
+
+        for out in (clusters_out, bases_out, n_mask_out):
+            out.flush()
+
+        shutil.rmtree(tile_dir, ignore_errors=True)
+        os.rename(tmp_dir, tile_dir)
+    finally:
+        # only left behind if the tile failed
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return tile_dir
+
+
+def store_tile_md5(tile_dir):
+    # one checksum over the files of a store tile, for resuming
+    md5 = hashlib.md5()
+
+    for name in STORE_FILES:
+        with open(os.path.join(tile_dir, name + '.npy'), 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                md5.update(block)
+
+    return md5.hexdigest()
+
+
+def verify_store_tiles(tiles_file):
+    # checks the tiles listed in a store_tiles file (tile, clusters and md5
+    # per line) against the tile directories next to it
+    lane_dir = os.path.dirname(tiles_file)
+
+    with open(tiles_file) as f:
+        for line in f:
+            tile, n_clusters, md5 = line.rstrip('\n').split('\t')
+            tile_dir = os.path.join(lane_dir, 'tile={}'.format(tile))
+
+            if (not os.path.isdir(tile_dir)
+                or store_tile_md5(tile_dir) != md5):
+                return False
+
+    return True
+
+
+def open_store_tile(store_dir, lane, tile, cycles=None):
+    # memory-maps a tile of the store. with cycles, bases and n_mask are
+    # restricted to those rows: a view if they're consecutive, else a copy
+    tile_dir = os.path.join(store_dir, 'lane={}'.format(lane),
+                            'tile={}'.format(tile))
+    load = lambda name: np.load(os.path.join(tile_dir, name + '.npy'),
+                                mmap_mode='r')
+
+    st = store_tile(lane, tile, load('cycles'), load('clusters'),
+                    load('bases'), load('n_mask'))
+
+    if cycles is not None:
+        rows = np.searchsorted(st.cycles, cycles)
+        if not np.array_equal(st.cycles[np.minimum(rows, len(st.cycles) - 1)],
+                              cycles):
+            raise ValueError('cycles {} are not all in the store'.format(
+                    list(cycles))
+            )
+
+        if np.array_equal(rows, np.arange(rows[0], rows[0] + len(rows))):
+            rows = slice(rows[0], rows[0] + len(rows))
+
+        st = st._replace(cycles=st.cycles[rows], bases=st.bases[rows],
+                         n_mask=st.n_mask[rows])
+
+    return st
+
+
+def store_lane_tiles(store_dir):
+    # {lane: sorted tiles} of the complete tiles in a store
+    lane_tiles = defaultdict(list)
+    for tile_dir in glob.glob(os.path.join(store_dir, 'lane=*', 'tile=*')):
+        lane_dir, tile_name = os.path.split(tile_dir)
+        lane_tiles[int(os.path.basename(lane_dir)[5:])].append(
+                int(tile_name[5:])
+        )
+
+    return {lane: sorted(tiles) for lane, tiles in lane_tiles.items()}
+
+
+def store_tiles(store_dir, lane=None, cycles=None):
+    # open_store_tile for every tile of a lane, or of the whole store
+    lane_tiles = store_lane_tiles(store_dir)
+
+    for l in (sorted(lane_tiles) if lane is None else [lane]):
+        for tile in lane_tiles.get(l, []):
+            yield open_store_tile(store_dir, l, tile, cycles)
+
+
+def unpack_store_tile(st):
+    return unpack_cycles(st.bases, st.n_mask, st.clusters.shape[0])
+
+
+def extract_store_tiles(store_dir, lane, i, nproc, cycles, chunk_clusters=None):
+    # extract_tiles for a decoded-cycle store: yields (tile, clusters, pf,
+    # byte_matrix) for the given cycles of every nproc-th tile of the lane.
+    # chunks are unpacked straight from the memory-mapped arrays, in multiples
+    # of 8 clusters so they start on a byte of n_mask. the store only holds PF
+    # clusters
+    tiles = store_lane_tiles(store_dir).get(lane, [])
+
+    for tile in tiles[i::nproc]:
+        st = open_store_tile(store_dir, lane, tile, cycles)
+        num_clusters = st.clusters.shape[0]
+
+        if chunk_clusters is None or chunk_clusters >= num_clusters:
+            chunks = [(0, num_clusters)]
+        else:
+            step = max(8, chunk_clusters - chunk_clusters % 8)
+            chunks = [(a, min(a + step, num_clusters))
+                      for a in range(0, num_clusters, step)]
+
+        for a, b in chunks:
+            byte_matrix = unpack_cycles(st.bases[:, a // 4:-(-b // 4)],
+                                        st.n_mask[:, a // 8:-(-b // 8)], b - a)
+
+            yield (tile, np.array(st.clusters[a:b]), np.ones(b - a, dtype=bool),
+                   byte_matrix)
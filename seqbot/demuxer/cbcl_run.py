@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+# a lazy, reusable view of a CBCL run for notebooks and QC scripts. nothing is
+# read until it's needed: the file layout on first use, then headers per cycle
+# file and filters per tile. decompressed tile blocks are kept in an LRU cache
+# bounded by cache_size bytes, so repeated queries over the same tiles don't
+# inflate them again. bcl_path can be a local path or an s3:// url
+#
+#   run = CbclRun('/mnt/SEQS/NovaSeq-01/180806_A00111_0181_AHFW7GDMXX')
+#   for reads in run.iter_tiles(lane=1, cycles=range(151, 159)):
+#       reads.bases, reads.qualities  # (clusters x cycles) uint8 arrays
+
+import threading
+import zlib
+
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import seqbot.demuxer.bcl2fu as bcl2fu
+
+
+# bases use 0-3 for ACGT and 4 for no-calls, as in bcl2fu.decode_basecalls
+tile_reads = namedtuple('tile_reads', ('lane', 'tile', 'clusters', 'pf',
+                                       'bases', 'qualities'))
+
+cache_stats = namedtuple('cache_stats', ('hits', 'misses', 'blocks',
+                                         'nbytes', 'max_nbytes'))
+
+
+class CbclRun(object):
+    def __init__(self, bcl_path, cache_size='1GiB', threads=4):
+        self.bcl_path = bcl_path
+        if isinstance(cache_size, str):
+            cache_size = bcl2fu.parse_size(cache_size)
+        self.cache_size = cache_size
+        self.threads = threads
+
+        self._file_lists = None
+        self._filter_files = None
+        self._headers = dict()
+        self._filters = dict()
+        self._tile_index = dict()
+
+        self._blocks = OrderedDict()
+        self._nbytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+        self.clear_cache()
+
+    def _layout(self):
+        if self._file_lists is None:
+            file_lists, filter_lists = bcl2fu.cbcl_globber(self.bcl_path)
+            self._filter_files = {
+                lane: {bcl2fu.get_tile(fn): fn for fn in filter_lists[lane]}
+                for lane in filter_lists
+            }
+            self._file_lists = file_lists
+
+        return self._file_lists
+
+    @property
+    def lanes(self):
+        return sorted({lane for lane, part in self._layout()})
+
+    def parts(self, lane):
+        return sorted(part for l, part in self._layout() if l == lane)
+
+    def cycles(self, lane):
+        # every part of a lane has the same cycles
+        return [bcl2fu.get_cycle(fn)
+                for fn in self._layout()[lane, self.parts(lane)[0]]]
+
+    def header(self, cbcl_file):
+        if cbcl_file not in self._headers:
+            self._headers[cbcl_file] = bcl2fu.read_cbcl_header(cbcl_file)
+
+        return self._headers[cbcl_file]
+
+    def _tiles(self, lane):
+        # tile number -> (part, index of the tile in that part's files)
+        if lane not in self._tile_index:
+            self._tile_index[lane] = {
+                int(tile): (part, tile_i)
+                for part in self.parts(lane)
+                for tile_i, tile in enumerate(
+                        self.header(self._layout()[lane, part][0]).tiles[:, 0]
+                )
+            }
+
+        return self._tile_index[lane]
+
+    def tiles(self, lane):
+        return sorted(self._tiles(lane))
+
+    def pf(self, lane, tile):
+        # passing-filter flags for every cluster in the tile
+        if (lane, tile) not in self._filters:
+            self._layout()
+            self._filters[lane, tile] = bcl2fu.read_tile_filter(
+                    self._filter_files[lane][tile]
+            )
+
+        return self._filters[lane, tile]
+
+    def cache_info(self):
+        with self._lock:
+            return cache_stats(self._hits, self._misses, len(self._blocks),
+                               self._nbytes, self.cache_size)
+
+    def clear_cache(self):
+        with self._lock:
+            self._blocks.clear()
+            self._nbytes = 0
+
+    def _block(self, cbcl_file, tile_i):
+        # the decompressed block of a tile, or None if it can't be read
+        key = (cbcl_file, tile_i)
+
+        with self._lock:
+            if key in self._blocks:
+                self._blocks.move_to_end(key)
+                self._hits += 1
+                return self._blocks[key]
+
+            self._misses += 1
+
+        ci = self.header(cbcl_file)
+        try:
+            block = zlib.decompress(
+                    bcl2fu.read_tile_block(cbcl_file, ci, tile_i), wbits=31
+            )
+        except zlib.error:
+            return None
+
+        block = np.frombuffer(block, dtype=np.uint8)
+        if block.shape[0] < (int(ci.tiles[tile_i, 1]) + 1) // 2:
+            return None
+
+        with self._lock:
+            if key not in self._blocks and block.nbytes <= self.cache_size:
+                self._blocks[key] = block
+                self._nbytes += block.nbytes
+
+                while self._nbytes > self.cache_size:
+                    _, old_block = self._blocks.popitem(last=False)
+                    self._nbytes -= old_block.nbytes
+
+        return block
+
+    def tile(self, lane, tile, cycles=None, pf_only=True):
+        # the bases and qualities of one tile, for all cycles or the given ones.
+        # the blocks of different cycles are inflated on a thread pool
+        part, tile_i = self._tiles(lane)[tile]
+        cbcl_files = self._layout()[lane, part]
+        if cycles is not None:
+            cycles = set(cycles)
+            cbcl_files = [fn for fn in cbcl_files
+                          if bcl2fu.get_cycle(fn) in cycles]
+
+        cf = self.pf(lane, tile)
+        clusters = bcl2fu.stored_clusters(self.header(cbcl_files[0]), cf)
+        num_clusters = clusters.shape[0]
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.threads)
+
+        # unreadable blocks are left as no-calls with quality 0
+        bases = np.full((num_clusters, len(cbcl_files)), 4, dtype=np.uint8)
+        qualities = np.zeros((num_clusters, len(cbcl_files)), dtype=np.uint8)
+
+        for j, (fn, block) in enumerate(zip(
+                cbcl_files,
+                self._executor.map(lambda fn: self._block(fn, tile_i),
+                                   cbcl_files)
+        )):
+            if block is not None:
+                bases[:, j] = bcl2fu.decode_basecalls(block, num_clusters)
+                qualities[:, j] = bcl2fu.decode_qscores(block, num_clusters,
+                                                        self.header(fn))
+
+        if pf_only:
+            keep = cf[clusters]
+            clusters = clusters[keep]
+            bases = bases[keep]
+            qualities = qualities[keep]
+
+        return tile_reads(lane, tile, clusters, cf[clusters], bases, qualities)
+
+    def iter_tiles(self, lane=None, cycles=None, pf_only=True):
+        # tile_reads for every tile of a lane, or of the whole run
+        for lane in (self.lanes if lane is None else [lane]):
+            for tile in self.tiles(lane):
+                yield self.tile(lane, tile, cycles, pf_only)
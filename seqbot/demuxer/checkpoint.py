@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+# checkpointing for read_extraction.py and barcode_count.py. each pool job is a
+# unit of work, (lane, part, tile_start, tile_end, i, nproc), that writes one
+# output file. outputs are written to a hidden temporary file and renamed into
+# place once complete, and the main process appends every finished unit with
+# its output file and md5 to a manifest in the output directory. with --resume
+# the units whose outputs are still intact are skipped
+
+import contextlib
+import hashlib
+import io
+import json
+import os
+
+
+# leading underscore so pyarrow.dataset ignores it in columnar output dirs
+MANIFEST_FILE = '_manifest.tsv'
+
+
+def unit_key(unit):
+    return '\t'.join(map(str, unit))
+
+
+def run_params(args, names):
+    # the arguments that have to match for a run to be resumed, normalized
+    # the way they'll read back from the manifest
+    return json.loads(json.dumps({name: getattr(args, name) for name in names}))
+
+
+def file_md5(file_name, block_size=2**20):
+    md5 = hashlib.md5()
+
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+
+    return md5.hexdigest()
+
+
+@contextlib.contextmanager
+def atomic_output(out_file):
+    # yields a temporary path that replaces out_file only if the block
+    # completes. it's a dotfile, so globs and pyarrow.dataset skip it
+    tmp_file = os.path.join(os.path.dirname(out_file),
+                            '.{}.tmp'.format(os.path.basename(out_file)))
+
+    try:
+        yield tmp_file
+
+        fd = os.open(tmp_file, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        os.replace(tmp_file, out_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+class HashingWriter(io.RawIOBase):
+    # a binary file wrapper that hashes everything written through it, so an
+    # output's md5 is known without reading it back
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.md5.update(b)
+        return self.f.write(b)
+
+    def tell(self):
+        return self.f.tell()
+
+    def flush(self):
+        self.f.flush()
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+@contextlib.contextmanager
+def hashed_output(out_file):
+    # atomic_output, but yields the temporary file opened for binary writing
+    # as a HashingWriter. its hexdigest() is the md5 of the output
+    with atomic_output(out_file) as tmp_file:
+        with open(tmp_file, 'wb') as f:
+            yield HashingWriter(f)
+
+
+def read_manifest(output_dir):
+    # returns the run parameters and {unit_key: (out_file, md5)} recorded by a
+    # previous run, or (None, {}). a torn last line is ignored
+    manifest_file = os.path.join(output_dir, MANIFEST_FILE)
+
+    params = None
+    completed = dict()
+
+    if not os.path.exists(manifest_file):
+        return params, completed
+
+    with open(manifest_file) as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == '#params':
+                params = json.loads(fields[1])
+            else:
+                completed[unit_key(fields[:-2])] = tuple(fields[-2:])
+
+    return params, completed
+
+
+def verify_outputs(output_dir, completed, verify=None):
+    # drops units whose output is missing or doesn't match its checksum. if
+    # given, verify(output path) also has to pass, e.g. to check the files an
+    # output refers to
+    return {
+        key: (out_file, md5) for key, (out_file, md5) in completed.items()
+        if os.path.exists(os.path.join(output_dir, out_file))
+        and file_md5(os.path.join(output_dir, out_file)) == md5
+        and (verify is None or verify(os.path.join(output_dir, out_file)))
+    }
+
+
+def open_manifest(output_dir, params, completed):
+    # starts a new manifest holding the completed units of a previous run (if
+    # any) and returns it open for appending
+    manifest_file = os.path.join(output_dir, MANIFEST_FILE)
+
+    with atomic_output(manifest_file) as tmp_file:
+        with open(tmp_file, 'w') as OUT:
+            print('#params\t{}'.format(json.dumps(params, sort_keys=True)),
+                  file=OUT)
+            for key in sorted(completed):
+                print('{}\t{}\t{}'.format(key, *completed[key]), file=OUT)
+
+    return open(manifest_file, 'a')
+
+
+def record_unit(manifest, output_dir, unit, out_file, md5):
+    print('{}\t{}\t{}'.format(unit_key(unit),
+                              os.path.relpath(out_file, output_dir), md5),
+          file=manifest)
+    manifest.flush()
+    os.fsync(manifest.fileno())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+# columnar (Arrow IPC / Parquet) output for extracted index reads and counts.
+# files are written per lane under lane={lane}/ directories, with one record
+# batch / row group per tile, so pyarrow.dataset can prune by lane and tile.
+# when tiles are decoded in chunks (see bcl2fu.plan_memory) read files get a
+# row group per chunk instead, which still never spans two tiles.
+#
+# barcodes are packed two bits per cycle (first cycle in the high bits) with
+# no-calls flagged in n_mask; see bcl2fu.pack_bases and bcl2fu.unpack_bases
+
+import contextlib
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import seqbot.demuxer.bcl2fu as bcl2fu
+
+
+OUTPUT_FORMATS = ('txt', 'arrow', 'parquet')
+
+FILE_EXTENSIONS = {'arrow': 'arrow', 'parquet': 'parquet'}
+
+
+def read_schema(n_cycles):
+    return pa.schema([('tile', pa.uint16()),
+                      ('cluster', pa.uint32()),
+                      ('pf', pa.bool_()),
+                      ('barcode', pa.uint64()),
+                      ('n_mask', pa.uint32())],
+                     metadata={'n_cycles': str(n_cycles)})
+
+
+def count_schema(n_cycles):
+    return pa.schema([('tile', pa.uint16()),
+                      ('barcode', pa.uint64()),
+                      ('n_mask', pa.uint32()),
+                      ('count', pa.uint64())],
+                     metadata={'n_cycles': str(n_cycles)})
+
+
+def output_path(output_dir, lane, name, output_format):
+    lane_dir = os.path.join(output_dir, 'lane={}'.format(lane))
+    os.makedirs(lane_dir, exist_ok=True)
+
+    return os.path.join(lane_dir,
+                        '{}.{}'.format(name, FILE_EXTENSIONS[output_format]))
+
+
+@contextlib.contextmanager
+def batch_writer(out_file, schema, output_format):
+    # yields a function that writes one record batch (one tile) at a time
+    if output_format == 'parquet':
+        writer = pq.ParquetWriter(out_file, schema)
+        write = lambda batch: writer.write_table(
+                pa.Table.from_batches([batch]), row_group_size=batch.num_rows
+        )
+    elif output_format == 'arrow':
+        writer = pa.ipc.new_file(out_file, schema)
+        write = writer.write_batch
+    else:
+        raise ValueError('unknown output format: {}'.format(output_format))
+
+    try:
+        yield write
+    finally:
+        writer.close()
+
+
+def read_batch(schema, tile, clusters, pf, byte_matrix):
+    barcode, n_mask = bcl2fu.pack_bases(byte_matrix)
+
+    return pa.RecordBatch.from_arrays(
+            [pa.array(np.full(clusters.shape[0], tile, dtype=np.uint16)),
+             pa.array(clusters.astype(np.uint32)),
+             pa.array(pf),
+             pa.array(barcode),
+             pa.array(n_mask)],
+            schema=schema
+    )
+
+
+def count_keys(byte_matrix):
+    keys = np.empty(byte_matrix.shape[0],
+                    dtype=[('barcode', np.uint64), ('n_mask', np.uint32)])
+    keys['barcode'], keys['n_mask'] = bcl2fu.pack_bases(byte_matrix)
+
+    return np.unique(keys, return_counts=True)
+
+
+def merge_counts(key_counts):
+    # combines (keys, counts) pairs from count_keys, e.g. the chunks of a tile
+    key_counts = list(key_counts)
+    keys, inverse = np.unique(np.concatenate([k for k, c in key_counts]),
+                              return_inverse=True)
+    counts = np.bincount(inverse.ravel(),
+                         weights=np.concatenate([c for k, c in key_counts]),
+                         minlength=keys.shape[0])
+
+    return keys, counts.astype(np.uint64)
+
+
+def count_batch(schema, tile, keys, counts):
+    return pa.RecordBatch.from_arrays(
+            [pa.array(np.full(keys.shape[0], tile, dtype=np.uint16)),
+             pa.array(keys['barcode']),
+             pa.array(keys['n_mask']),
+             pa.array(counts.astype(np.uint64))],
+            schema=schema
+    )
+
+
+def decode_barcodes(table):
+    # convenience for notebooks: turn packed barcodes back into strings
+    n_cycles = int(table.schema.metadata[b'n_cycles'])
+    byte_matrix = bcl2fu.unpack_bases(
+            table.column('barcode').to_numpy(),
+            table.column('n_mask').to_numpy(),
+            n_cycles
+    )
+
+    return [''.join('ACGTN'[b] for b in row) for row in byte_matrix]
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# dual-index pair counting. i7 and i5 are encoded separately against the
+# expected samplesheet barcodes (exact matches only, anything else goes in an
+# "other" bucket) and pairs are counted with a single bincount over
+# i7_id * (n_i5 + 1) + i5_id, giving an (n_i7 + 1) x (n_i5 + 1) matrix.
+# reads whose i7 and i5 are both expected but aren't a samplesheet pair are
+# counted as index hopping
+
+import csv
+import gzip
+
+from collections import namedtuple
+
+import numpy as np
+
+import seqbot.demuxer.bcl2fu as bcl2fu
+
+
+dual_index = namedtuple('dual_index', ('i7', 'i5', 'i7_cycles', 'pairs'))
+
+OTHER = 'other'
+
+complement = str.maketrans('ACGT', 'TGCA')
+
+
+def read_samplesheet_indexes(samplesheet, i5_rc=False):
+    # returns (lane, index, index2) for each sample row, lane is None if the
+    # samplesheet doesn't split lanes
+    with open(samplesheet) as f:
+        rows = list(csv.reader(f))
+
+    # find the [Data] section, the next line is the header
+    h_i = [i for i,r in enumerate(rows) if r and r[0] == '[Data]'][0]
+    h_row = list(map(str.lower, rows[h_i + 1]))
+
+    if 'index' not in h_row or 'index2' not in h_row:
+        raise ValueError("Samplesheet needs index and index2 columns for "
+                         "dual-index counting")
+
+    index_i = h_row.index('index')
+    index2_i = h_row.index('index2')
+    lane_i = h_row.index('lane') if 'lane' in h_row else None
+
+    sample_indexes = []
+    for r in rows[h_i + 2:]:
+        if not any(r):
+            continue
+
+        index2 = r[index2_i].upper()
+        if i5_rc:
+            index2 = index2.translate(complement)[::-1]
+
+        sample_indexes.append((None if lane_i is None else int(r[lane_i]),
+                               r[index_i].upper(), index2))
+
+    return sample_indexes
+
+
+def get_dual_index(sample_indexes, i7_cycles):
+    i7 = tuple(sorted({index for lane, index, index2 in sample_indexes}))
+    i5 = tuple(sorted({index2 for lane, index, index2 in sample_indexes}))
+
+    if len({len(s) for s in i7}) != 1 or len({len(s) for s in i5}) != 1:
+        raise ValueError('i7 and i5 barcodes must each have a single length')
+
+    pairs = dict()
+    for lane, index, index2 in sample_indexes:
+        pairs.setdefault(lane, set()).add((i7.index(index), i5.index(index2)))
+
+    return dual_index(i7, i5, i7_cycles, pairs)
+
+
+def encode_sequences(seqs):
+    byte_matrix = np.array([['ACGT'.index(c) for c in s] for s in seqs],
+                           dtype=np.uint8)
+    return bcl2fu.pack_bases(byte_matrix)[0]
+
+
+def encode_index(byte_matrix, seqs):
+    # id of the matching expected sequence for each read, len(seqs) if none.
+    # packed codes sort the same way as the sequences, so seqs can be searched
+    codes = encode_sequences(seqs)
+    packed, n_mask = bcl2fu.pack_bases(byte_matrix[:, :len(seqs[0])])
+
+    ids = np.searchsorted(codes, packed)
+    found = (ids < len(seqs))
+    found[found] = codes[ids[found]] == packed[found]
+    found &= (n_mask == 0)
+
+    return np.where(found, ids, len(seqs))
+
+
+def pair_counts(byte_matrix, di):
+    i7_ids = encode_index(byte_matrix[:, :di.i7_cycles], di.i7)
+    i5_ids = encode_index(byte_matrix[:, di.i7_cycles:], di.i5)
+
+    n_i7 = len(di.i7) + 1
+    n_i5 = len(di.i5) + 1
+
+    return np.bincount(i7_ids * n_i5 + i5_ids,
+                       minlength=n_i7 * n_i5).reshape((n_i7, n_i5))
+
+
+def expected_pairs(di, lane):
+    return di.pairs.get(lane, di.pairs.get(None, set()))
+
+
+def hopping_report(lane, matrix, di):
+    # returns a summary row for the lane and a list of unexpected pairs,
+    # most frequent first
+    pairs = expected_pairs(di, lane)
+
+    total = int(matrix.sum())
+    both_known = int(matrix[:-1, :-1].sum())
+    expected = sum(int(matrix[i, j]) for i, j in pairs)
+    hopped = both_known - expected
+
+    summary = (lane, total, both_known, expected, hopped,
+               hopped / both_known if both_known else 0.0)
+
+    unexpected = [(lane, di.i7[i], di.i5[j], int(matrix[i, j]),
+                   matrix[i, j] / both_known)
+                  for i, j in zip(*np.nonzero(matrix[:-1, :-1]))
+                  if (i, j) not in pairs]
+    unexpected.sort(key=lambda r: r[3], reverse=True)
+
+    return summary, unexpected
+
+
+def write_pair_matrix(out_file, matrix, di):
+    with gzip.open(out_file, 'wt') as OUT:
+        print('\t'.join(('i7\\i5',) + di.i5 + (OTHER,)), file=OUT)
+        for name, row in zip(di.i7 + (OTHER,), matrix):
+            print('\t'.join([name] + [str(c) for c in row]), file=OUT)
+
+
+def write_hopping_report(summary_file, unexpected_file, reports):
+    with open(summary_file, 'w') as OUT:
+        print('\t'.join(('lane', 'reads', 'both_indexes_expected',
+                         'expected_pairs', 'unexpected_pairs',
+                         'hopping_rate')), file=OUT)
+        for summary, unexpected in reports:
+            print('\t'.join(map(str, summary)), file=OUT)
+
+    with open(unexpected_file, 'w') as OUT:
+        print('\t'.join(('lane', 'i7', 'i5', 'count', 'fraction')), file=OUT)
+        for summary, unexpected in reports:
+            for row in unexpected:
+                print('\t'.join(map(str, row)), file=OUT)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+# merges the output directories of sharded read_extraction.py or
+# barcode_count.py runs: text reads (index_reads_*) are concatenated (gzip
+# members can simply be appended), text counts (index_counts_*) and pair
+# matrices are summed, and columnar files and decoded-cycle store tiles are
+# collected into one lane-partitioned dataset
+
+import argparse
+import glob
+import gzip
+import logging
+import os
+import shutil
+
+import numpy as np
+
+import seqbot.demuxer.bcl2fu as bcl2fu
+import seqbot.demuxer.index_hopping as index_hopping
+
+import utilities.log_util as ut_log
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+            prog='merge_shards.py',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument('--loglevel', type=int, default=logging.DEBUG)
+
+    parser.add_argument('--output_dir', required=True)
+    parser.add_argument('shard_dirs', nargs='+')
+
+    # to redo the index hopping report from the summed pair matrices
+    parser.add_argument('--samplesheet', default=None)
+    parser.add_argument('--i5_rc', action='store_true')
+
+    return parser
+
+
+def concatenate_reads(txt_files, out_file):
+    with open(out_file, 'wb') as OUT:
+        for txt_file in txt_files:
+            with open(txt_file, 'rb') as f:
+                shutil.copyfileobj(f, OUT)
+
+
+def read_counts(txt_file):
+    # the (read, count) lines of a count file, which barcode_count.py writes
+    # sorted by read
+    last_read = None
+
+    with gzip.open(txt_file, 'rt') as f:
+        for line in f:
+            index, count = line.split('\t')
+            if last_read is not None and index < last_read:
+                raise ValueError('{} is not sorted by read'.format(txt_file))
+            last_read = index
+
+            yield index, int(count)
+
+
+def sum_counts(txt_files, out_file):
+    # streams the sorted shard counts, so the merged file is sorted too and
+    # no shard is held in memory
+    with gzip.open(out_file, 'wt') as OUT:
+        for index, count in bcl2fu.merge_sorted_counts(
+                map(read_counts, txt_files)
+        ):
+            print('{}\t{}'.format(index, count), file=OUT)
+
+
+def read_pair_matrix(matrix_file):
+    with gzip.open(matrix_file, 'rt') as f:
+        rows = [line.rstrip('\n').split('\t') for line in f]
+
+    i5 = tuple(rows[0][1:-1])
+    i7 = tuple(r[0] for r in rows[1:-1])
+    matrix = np.array([[int(c) for c in r[1:]] for r in rows[1:]])
+
+    return i7, i5, matrix
+
+
+def merge_pair_matrices(matrix_files, output_dir, samplesheet, i5_rc, logger):
+    lane_matrices = dict()
+
+    for matrix_file in matrix_files:
+        lane = int(os.path.basename(matrix_file)[len('pair_counts_L'):][:3])
+        i7, i5, matrix = read_pair_matrix(matrix_file)
+        lane_matrices[lane] = lane_matrices.get(lane, 0) + matrix
+
+    di = index_hopping.dual_index(i7, i5, None, {})
+    if samplesheet:
+        di = index_hopping.get_dual_index(
+                index_hopping.read_samplesheet_indexes(samplesheet, i5_rc), None
+        )
+        assert (di.i7, di.i5) == (i7, i5), "samplesheet doesn't match matrices"
+
+    reports = []
+    for lane in sorted(lane_matrices):
+        index_hopping.write_pair_matrix(
+                os.path.join(output_dir, 'pair_counts_L{:03d}.txt.gz'.format(lane)),
+                lane_matrices[lane], di
+        )
+
+        if samplesheet:
+            reports.append(index_hopping.hopping_report(
+                    lane, lane_matrices[lane], di
+            ))
+            logger.info('lane {}: {:.4%} index hopping'.format(
+                    lane, reports[-1][0][-1])
+            )
+
+    if samplesheet:
+        index_hopping.write_hopping_report(
+                os.path.join(output_dir, 'index_hopping.txt'),
+                os.path.join(output_dir, 'unexpected_pairs.txt'),
+                reports
+        )
+
+
+def main(logger):
+    parser = get_parser()
+
+    args = parser.parse_args()
+
+    logger.setLevel(args.loglevel)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    read_files = []
+    count_files = []
+    matrix_files = []
+
+    for k, shard_dir in enumerate(args.shard_dirs):
+        for fn in sorted(glob.glob(os.path.join(shard_dir, '*.txt.gz'))):
+            if os.path.basename(fn).startswith('pair_counts_'):
+                matrix_files.append(fn)
+            elif os.path.basename(fn).startswith('index_counts_'):
+                count_files.append(fn)
+            elif os.path.basename(fn).startswith('index_reads_'):
+                read_files.append(fn)
+
+        # columnar outputs are already split by lane, just collect them
+        for fn in glob.glob(os.path.join(shard_dir, 'lane=*', '*')):
+            lane_dir = os.path.join(args.output_dir,
+                                    os.path.basename(os.path.dirname(fn)))
+            os.makedirs(lane_dir, exist_ok=True)
+
+            # decoded-cycle store tiles don't overlap between shards
+            if os.path.isdir(fn):
+                shutil.copytree(fn, os.path.join(lane_dir,
+                                                 os.path.basename(fn)))
+            else:
+                shutil.copy(fn, os.path.join(
+                        lane_dir, 'shard{}_{}'.format(k, os.path.basename(fn))
+                ))
+
+    logger.info('merging {} read files, {} count files and {} pair matrices '
+                'from {} shards'.format(len(read_files), len(count_files),
+                                        len(matrix_files), len(args.shard_dirs))
+    )
+
+    if read_files:
+        concatenate_reads(read_files,
+                          os.path.join(args.output_dir, 'index_reads.txt.gz'))
+
+    if count_files:
+        sum_counts(count_files,
+                   os.path.join(args.output_dir, 'index_counts.txt.gz'))
+
+    if matrix_files:
+        merge_pair_matrices(matrix_files, args.output_dir, args.samplesheet,
+                            args.i5_rc, logger)
+
+    logger.info('done!')
+
+
+if __name__ == "__main__":
+    mainlogger, log_file, file_handler = ut_log.get_logger('merge_shards')
+
+    main(mainlogger)
@@ -6,16 +6,30 @@ import itertools
 import logging
 import os
 import threading
+import time
 
 from collections import defaultdict
 
 import multiprocessing as mp
 
 import seqbot.demuxer.bcl2fu as bcl2fu
+import seqbot.demuxer.checkpoint as checkpoint
+import seqbot.demuxer.columnar as columnar
+import seqbot.demuxer.storage as storage
 
 import utilities.log_util as ut_log
 
 
+cbcl_data = defaultdict(dict)
+cbcl_filter_data = defaultdict(dict)
+
+# the arguments that have to match to resume a run
+RUN_PARAMS = ('bcl_path', 'index_cycle_start', 'index_cycle_end',
+              'output_format', 'n_threads', 'lane', 'part',
+              'tile_start', 'tile_end')
+
+
+
 def get_parser():
     parser = argparse.ArgumentParser(
             prog='read_extraction.py',
@@ -31,28 +45,90 @@ def get_parser():
     parser.add_argument('--index_cycle_start', required=True, type=int)
     parser.add_argument('--index_cycle_end', required=True, type=int)
 
+    # store: a PF-filtered, 2-bit packed decoded-cycle store that later
+    # passes can memory-map, see bcl2fu.open_store_tile
+    parser.add_argument('--output_format', default='txt',
+                        choices=columnar.OUTPUT_FORMATS + ('store',))
+
+    parser.add_argument('--queue_depth', type=int, default=2)
+    parser.add_argument('--decode_threads', type=int, default=1)
+    parser.add_argument('--io_threads', type=int, default=1)
+
+    # e.g. 30GiB: caps the pool size and decodes tiles in chunks to fit
+    parser.add_argument('--max_memory', default=None)
+
+    # restrict to one shard of the run, see run_layout.py
+    parser.add_argument('--lane', type=int, default=None)
+    parser.add_argument('--part', type=int, default=None)
+    parser.add_argument('--tile_start', type=int, default=0)
+    parser.add_argument('--tile_end', type=int, default=None)
+
+    # skip the units already completed by an interrupted run
+    parser.add_argument('--resume', action='store_true')
+
+    parser.add_argument('--s3_endpoint_url', default=None)
+    parser.add_argument('--s3_cache_dir', default=storage.config['cache_dir'])
+    parser.add_argument('--s3_cache_size', default='32GiB')
+
     return parser
 
 
 def read_processor(args):
-    cbcl_files, cbcl_filter_files, i, nproc, out_file = args
+    (unit, cbcl_files, lane, i, nproc,
+     out_file, output_format, pipeline_opts) = args
 
     try:
-        msg = 'starting pooljob with args: ({}..., {}..., {}, {})'.format(
-            cbcl_files[0], cbcl_filter_files[0], i, nproc
+        msg = 'starting pooljob with args: ({}..., {}, {}, {})'.format(
+            cbcl_files[0], lane, i, nproc
         )
         log_queue.put((msg, logging.DEBUG))
 
-        with gzip.open(out_file, 'wt') as OUT:
-            for read in bcl2fu.extract_reads(
-                cbcl_files, cbcl_filter_files, i, nproc
-            ):
-                print(read, file=OUT)
-
-        msg = 'pooljob done for args: ({}..., {}..., {}, {})'.format(
-            cbcl_files[0], cbcl_filter_files[0], i, nproc
+        with checkpoint.hashed_output(out_file) as OUT:
+            if output_format == 'txt':
+                with gzip.open(OUT, 'wt') as GZ:
+                    for read in bcl2fu.extract_reads(
+                        cbcl_files, cbcl_data[lane], cbcl_filter_data[lane],
+                        i, nproc, **pipeline_opts
+                    ):
+                        print(read, file=GZ)
+            elif output_format == 'store':
+                # each tile is written chunk by chunk as it's decoded, and the
+                # unit's file lists the tiles it wrote with their checksums
+                cycles = [bcl2fu.get_cycle(fn) for fn in cbcl_files]
+                for tile, tile_chunks in itertools.groupby(
+                    bcl2fu.extract_tiles(
+                        cbcl_files, cbcl_data[lane], cbcl_filter_data[lane],
+                        i, nproc, **pipeline_opts
+                    ),
+                    key=lambda tile_chunk: tile_chunk[0]
+                ):
+                    n_clusters = int(cbcl_filter_data[lane][tile].sum())
+                    tile_dir = bcl2fu.write_store_tile(
+                        os.path.dirname(out_file), tile, cycles, n_clusters,
+                        ((clusters, byte_matrix)
+                         for _, clusters, _, byte_matrix in tile_chunks)
+                    )
+                    OUT.write('{}\t{}\t{}\n'.format(
+                        tile, n_clusters, bcl2fu.store_tile_md5(tile_dir)
+                    ).encode())
+            else:
+                schema = columnar.read_schema(len(cbcl_files))
+                with columnar.batch_writer(OUT, schema,
+                                           output_format) as write:
+                    for tile, clusters, pf, byte_matrix in bcl2fu.extract_tiles(
+                        cbcl_files, cbcl_data[lane], cbcl_filter_data[lane],
+                        i, nproc, pf_only=False, **pipeline_opts
+                    ):
+                        write(columnar.read_batch(
+                            schema, tile, clusters, pf, byte_matrix
+                        ))
+
+        msg = 'pooljob done for args: ({}..., {}, {}, {})'.format(
+            cbcl_files[0], lane, i, nproc
         )
         log_queue.put((msg, logging.DEBUG))
+
+        return unit, out_file, OUT.hexdigest()
     except Exception as detail:
         log_queue.put(("encountered exception in process:\n{}".format(detail),
                        logging.INFO))
@@ -63,44 +139,124 @@ def main(logger):
 
     args = parser.parse_args()
 
+    if (args.output_format in ('arrow', 'parquet')
+        and (args.index_cycle_end - args.index_cycle_start
+             > bcl2fu.MAX_PACKED_CYCLES)):
+        parser.error('--output_format {} holds at most {} cycles'.format(
+            args.output_format, bcl2fu.MAX_PACKED_CYCLES)
+        )
+
+    # bcl_path can be an s3:// url, in which case only the needed blocks are read
+    storage.configure(endpoint_url=args.s3_endpoint_url,
+                      cache_dir=args.s3_cache_dir,
+                      cache_max_bytes=bcl2fu.parse_size(args.s3_cache_size))
+
     logger.setLevel(args.loglevel)
 
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    params = checkpoint.run_params(args, RUN_PARAMS)
+    if args.resume:
+        old_params, completed = checkpoint.read_manifest(args.output_dir)
+        if old_params is not None and old_params != params:
+            parser.error('--resume: {} was written with different arguments'.format(
+                os.path.join(args.output_dir, checkpoint.MANIFEST_FILE))
+            )
+
+        # store units are only done if the tiles they list are intact too
+        completed = checkpoint.verify_outputs(
+            args.output_dir, completed,
+            bcl2fu.verify_store_tiles if args.output_format == 'store' else None
+        )
+        logger.info('resuming, {} units already complete'.format(len(completed)))
+    else:
+        completed = dict()
+
+    discovery_start = time.time()
+
     cbcl_file_lists, cbcl_filter_lists = bcl2fu.cbcl_globber(args.bcl_path)
 
+    logger.info('found {} lane/parts and {} filter files in {:.1f}s'.format(
+        len(cbcl_file_lists), sum(map(len, cbcl_filter_lists.values())),
+        time.time() - discovery_start)
+    )
+
     in_range = lambda cfn: (args.index_cycle_start
                             <= bcl2fu.get_cycle(cfn)
                             < args.index_cycle_end)
 
+    in_shard = lambda lane, part: ((args.lane is None or lane == args.lane)
+                                   and (args.part is None or part == args.part))
+    tile_range = (args.tile_start, args.tile_end)
+
     cbcl_file_lists = {
         (lane, part):tuple(cfn for cfn in cbcl_file_lists[lane, part]
                            if in_range(cfn))
         for lane,part in cbcl_file_lists
-    }
-
-    cbcl_filter_lists = {
-        lane: bcl2fu.read_lane_filters(cbcl_filter_lists[lane]) 
-        for lane in cbcl_filter_lists
+        if in_shard(lane, part)
     }
 
     logger.info('{} CBCL files to read'.format(
         sum(map(len, cbcl_file_lists.values())))
     )
 
+    global cbcl_data
+    global cbcl_filter_data
+
     lane_parts = sorted(cbcl_file_lists)
 
+    cbcl_number_of_tiles = bcl2fu.get_cbcl_data(
+        cbcl_data, cbcl_file_lists, lane_parts, logger
+    )
+
+    cbcl_filter_lists = bcl2fu.shard_filter_lists(
+            cbcl_filter_lists, cbcl_data, cbcl_file_lists, tile_range
+        )
+
+    for lane in cbcl_filter_lists:
+        cbcl_filter_data[lane].update(
+            bcl2fu.read_lane_filters(cbcl_filter_lists[lane])
+        )
+
+    logger.info('{} total tiles, read headers and filters in {:.1f}s'.format(
+        sum(cbcl_number_of_tiles), time.time() - discovery_start)
+    )
+
+    if args.max_memory:
+        try:
+            n_procs, chunk_clusters = bcl2fu.plan_memory(
+                bcl2fu.parse_size(args.max_memory), cbcl_data, cbcl_file_lists,
+                cbcl_filter_data, args.n_threads, args.queue_depth,
+                args.decode_threads, store_output=args.output_format == 'store'
+            )
+        except ValueError as detail:
+            parser.error('--max_memory: {}'.format(detail))
+
+        logger.info('memory budget of {}: {} processes, {}'.format(
+            args.max_memory, n_procs,
+            'chunks of {} clusters'.format(chunk_clusters) if chunk_clusters
+            else 'whole tiles')
+        )
+    else:
+        n_procs, chunk_clusters = args.n_threads, None
+
+    pipeline_opts = {'queue_depth': args.queue_depth,
+                     'decode_threads': args.decode_threads,
+                     'io_threads': args.io_threads,
+                     'chunk_clusters': chunk_clusters,
+                     'tile_range': tile_range}
+
     global log_queue
     log_queue, log_thread = ut_log.get_thread_logger(logger)
 
-    logger.debug('initializing pool of {} processes'.format(args.n_threads))
+    logger.debug('initializing pool of {} processes'.format(n_procs))
 
-    pool = mp.Pool(args.n_threads, maxtasksperchild=1)
+    pool = mp.Pool(n_procs, maxtasksperchild=1)
 
     logger.info('reading {} files and aggregating counters'.format(
             sum(map(len, cbcl_file_lists.values()))
     ))
 
-    output_file = os.path.join(args.output_dir, 'index_counts_{}.txt.gz')
-
     # warning: gratuitous use of itertools module ahead! it's gonna be great
 
     # lambda function to make this crazy itertools chain.
@@ -109,24 +265,68 @@ def main(logger):
         map(itertools.repeat, s, itertools.repeat(args.n_threads))
     )
 
+    if args.output_format == 'txt':
+        output_file = os.path.join(args.output_dir, 'index_reads_{}.txt.gz')
+        output_files = map(output_file.format, itertools.count())
+    elif args.output_format == 'store':
+        for lane in cbcl_filter_lists:
+            os.makedirs(os.path.join(args.output_dir, 'lane={}'.format(lane)),
+                        exist_ok=True)
+
+        output_files = (
+            os.path.join(args.output_dir, 'lane={}'.format(lane),
+                         'store_tiles_{}.txt'.format(n))
+            for n, (lane, part) in enumerate(rep_n(lane_parts))
+        )
+    else:
+        output_files = (
+            columnar.output_path(args.output_dir, lane,
+                                 'index_reads_{}'.format(n), args.output_format)
+            for n, (lane, part) in enumerate(rep_n(lane_parts))
+        )
+
+    # one unit of work per job, the same every time for the same arguments
+    units = [(lane, part) + tile_range + (i, args.n_threads)
+             for (lane, part), i in zip(rep_n(lane_parts),
+                                        itertools.cycle(range(args.n_threads)))]
+
+    jobs = [
+        job for job in zip(
+            units,
+            rep_n(cbcl_file_lists[lane, part] for lane,part in lane_parts),
+            rep_n(lane for lane,part in lane_parts),
+            itertools.cycle(range(args.n_threads)),
+            itertools.repeat(args.n_threads),
+            output_files,
+            itertools.repeat(args.output_format),
+            itertools.repeat(pipeline_opts)
+        )
+        if checkpoint.unit_key(job[0]) not in completed
+    ]
+    logger.info('{} of {} units to run'.format(len(jobs), len(units)))
+
+    manifest = checkpoint.open_manifest(args.output_dir, params, completed)
+
     # using imap_unordered to (maybe) keep memory usage low in the main thread
+    n_done = 0
     try:
         logger.debug('starting demux')
-        for i,_ in enumerate(pool.imap_unordered(
-            read_processor,
-            zip(
-                rep_n(cbcl_file_lists[lane, part] for lane,part in lane_parts),
-                rep_n(cbcl_filter_lists[lane][part] for lane,part in lane_parts),
-                itertools.cycle(range(args.n_threads)),
-                itertools.repeat(args.n_threads),
-                map(output_file.format, itertools.count())
-            )
-        )):
+        for i,result in enumerate(pool.imap_unordered(read_processor, jobs)):
+            if result is not None:
+                checkpoint.record_unit(manifest, args.output_dir, *result)
+                n_done += 1
+
             if i % 100 == 0:
                 logger.info(f'{i}')
     finally:
         pool.close()
         pool.join()
+        manifest.close()
+
+    if n_done < len(jobs):
+        logger.warning('{} units failed, rerun with --resume to redo them'.format(
+            len(jobs) - n_done)
+        )
 
     log_queue.put('STOP')
     log_thread.join()
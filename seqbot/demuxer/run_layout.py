@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# reads the lane/part/tile layout of a run and writes one small file per shard
+# containing the arguments that restrict read_extraction.py or
+# barcode_count.py to that shard. bcl2fastq.rf runs one exec per file.
+
+import argparse
+import logging
+import os
+
+import seqbot.demuxer.bcl2fu as bcl2fu
+import seqbot.demuxer.storage as storage
+
+import utilities.log_util as ut_log
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+            prog='run_layout.py',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument('--loglevel', type=int, default=logging.DEBUG)
+
+    parser.add_argument('--bcl_path', required=True)
+    parser.add_argument('--output_dir', required=True)
+
+    parser.add_argument('--tiles_per_shard', type=int, default=16)
+
+    parser.add_argument('--s3_endpoint_url', default=None)
+    parser.add_argument('--s3_cache_dir', default=storage.config['cache_dir'])
+    parser.add_argument('--s3_cache_size', default='32GiB')
+
+    return parser
+
+
+def get_shards(cbcl_file_lists, tiles_per_shard):
+    # (lane, part, tile_start, tile_end) for every shard of the run, using the
+    # header of the first cycle of each part (all cycles share a tile layout)
+    shards = []
+
+    cbcl_headers = bcl2fu.read_cbcl_headers(
+            [cbcl_files[0] for cbcl_files in cbcl_file_lists.values()]
+    )
+
+    for lane, part in sorted(cbcl_file_lists):
+        num_tiles = cbcl_headers[cbcl_file_lists[lane, part][0]].num_tiles
+
+        for tile_start in range(0, num_tiles, tiles_per_shard):
+            shards.append((lane, part, tile_start,
+                           min(tile_start + tiles_per_shard, num_tiles)))
+
+    return shards
+
+
+def main(logger):
+    parser = get_parser()
+
+    args = parser.parse_args()
+
+    logger.setLevel(args.loglevel)
+
+    storage.configure(endpoint_url=args.s3_endpoint_url,
+                      cache_dir=args.s3_cache_dir,
+                      cache_max_bytes=bcl2fu.parse_size(args.s3_cache_size))
+
+    cbcl_file_lists, cbcl_filter_lists = bcl2fu.cbcl_globber(args.bcl_path)
+
+    shards = get_shards(cbcl_file_lists, args.tiles_per_shard)
+    logger.info('{} shards over {} lane/parts'.format(
+            len(shards), len(cbcl_file_lists))
+    )
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    for lane, part, tile_start, tile_end in shards:
+        shard_file = os.path.join(
+                args.output_dir,
+                'L{:03d}_{}_{:03d}-{:03d}.txt'.format(lane, part,
+                                                      tile_start, tile_end)
+        )
+        with open(shard_file, 'w') as OUT:
+            print('--lane {} --part {} --tile_start {} --tile_end {}'.format(
+                    lane, part, tile_start, tile_end), file=OUT)
+
+    logger.info('done!')
+
+
+if __name__ == "__main__":
+    mainlogger, log_file, file_handler = ut_log.get_logger('run_layout')
+
+    main(mainlogger)
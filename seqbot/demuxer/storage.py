@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+# read access for run folders that are either local or on S3. s3:// paths are
+# read with ranged GETs through one pooled boto3 client per process, and the
+# fetched bytes are kept in a local on-disk block cache (shared between pool
+# processes), so reading a few index cycles only transfers those tile blocks.
+# cached blocks are keyed on the object's ETag, so a rewritten object is never
+# served stale, and the cache is pruned to cache_max_bytes (least recently
+# used first) whenever it's configured.
+#
+# for testing against a local S3 stand-in (moto, minio, ...), point
+# endpoint_url at it with configure()
+
+import os
+import tempfile
+import threading
+
+import boto3
+import botocore.config
+
+
+config = {
+    'endpoint_url': None,
+    'cache_dir': os.path.join(tempfile.gettempdir(), 'seqbot_s3_cache'),
+    'cache_max_bytes': 32 * 2**30,
+    'block_size': 256 * 2**10,
+    'max_pool_connections': 16
+}
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+# listings are cached per prefix, they don't change while a run is read
+_listings = dict()
+
+
+def configure(**kwargs):
+    global _client
+
+    unknown = set(kwargs) - set(config)
+    if unknown:
+        raise ValueError('unknown storage options: {}'.format(sorted(unknown)))
+
+    config.update(kwargs)
+    _client = None
+    _listings.clear()
+
+    prune_cache()
+
+
+def is_s3(path):
+    return path.startswith('s3://')
+
+
+def split_s3(path):
+    bucket, _, key = path[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def get_client():
+    # boto3 clients aren't safe to share across a fork, so each process makes
+    # its own. within a process the client (and its connection pool) is shared
+    global _client, _client_pid
+
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = boto3.client(
+                    's3', endpoint_url=config['endpoint_url'],
+                    config=botocore.config.Config(
+                            max_pool_connections=config['max_pool_connections']
+                    )
+            )
+            _client_pid = os.getpid()
+
+    return _client
+
+
+def list_objects(prefix):
+    # returns {path: (size, etag)} for every object under an s3:// prefix
+    if prefix not in _listings:
+        bucket, key_prefix = split_s3(prefix)
+        paginator = get_client().get_paginator('list_objects_v2')
+
+        _listings[prefix] = {
+            's3://{}/{}'.format(bucket, r['Key']): (r['Size'],
+                                                    r['ETag'].strip('"'))
+            for result in paginator.paginate(Bucket=bucket, Prefix=key_prefix)
+            for r in result.get('Contents', [])
+        }
+
+    return _listings[prefix]
+
+
+def list_dir(path):
+    # names of the entries (files and directories) directly under path
+    if not is_s3(path):
+        with os.scandir(path) as entries:
+            return sorted(entry.name for entry in entries)
+
+    bucket, key_prefix = split_s3(path.rstrip('/') + '/')
+    paginator = get_client().get_paginator('list_objects_v2')
+
+    names = set()
+    for result in paginator.paginate(Bucket=bucket, Prefix=key_prefix,
+                                     Delimiter='/'):
+        names.update(r['Prefix'][len(key_prefix):].rstrip('/')
+                     for r in result.get('CommonPrefixes', []))
+        names.update(r['Key'][len(key_prefix):]
+                     for r in result.get('Contents', []))
+
+    return sorted(names)
+
+
+def walk_files(path):
+    # every file below path: one os.scandir per directory, or a single
+    # (cached) listing on S3
+    if is_s3(path):
+        return sorted(list_objects(path.rstrip('/') + '/'))
+
+    files = []
+    dirs = [path]
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dirs.append(entry.path)
+                else:
+                    files.append(entry.path)
+
+    return sorted(files)
+
+
+def object_info(path):
+    # (size, etag) of an s3:// object, from a cached listing if there is one
+    for prefix, listing in _listings.items():
+        if path in listing:
+            return listing[path]
+
+    bucket, key = split_s3(path)
+    response = get_client().head_object(Bucket=bucket, Key=key)
+
+    return response['ContentLength'], response['ETag'].strip('"')
+
+
+def object_size(path):
+    if not is_s3(path):
+        return os.path.getsize(path)
+
+    return object_info(path)[0]
+
+
+def coalesce(ranges, max_gap=0):
+    # merge (start, stop) ranges that overlap or are within max_gap of each other
+    merged = []
+
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1] + max_gap:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+
+    return [tuple(r) for r in merged]
+
+
+def prune_cache(max_bytes=None):
+    # deletes the least recently used blocks until the cache fits in
+    # max_bytes (default cache_max_bytes). reads touch a block's mtime
+    if max_bytes is None:
+        max_bytes = config['cache_max_bytes']
+
+    if config['cache_dir'] is None or not os.path.isdir(config['cache_dir']):
+        return
+
+    blocks = []
+    for dir_path, _, file_names in os.walk(config['cache_dir']):
+        for file_name in file_names:
+            try:
+                st = os.stat(os.path.join(dir_path, file_name))
+            except FileNotFoundError:
+                continue
+            blocks.append((st.st_mtime, st.st_size,
+                           os.path.join(dir_path, file_name)))
+
+    total = sum(size for _, size, _ in blocks)
+    for mtime, size, cache_file in sorted(blocks):
+        if total <= max_bytes:
+            break
+
+        try:
+            os.remove(cache_file)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def _cache_path(bucket, key, etag, block_i):
+    return os.path.join(config['cache_dir'], bucket, '{}.{}.{}-{}'.format(
+            key, etag, config['block_size'], block_i)
+    )
+
+
+def _read_cached_block(bucket, key, etag, block_i):
+    if config['cache_dir'] is None:
+        return None
+
+    cache_file = _cache_path(bucket, key, etag, block_i)
+    try:
+        with open(cache_file, 'rb') as f:
+            data = f.read()
+        os.utime(cache_file)
+    except FileNotFoundError:
+        return None
+
+    return data
+
+
+def _write_cached_block(bucket, key, etag, block_i, data):
+    if config['cache_dir'] is None:
+        return
+
+    cache_file = _cache_path(bucket, key, etag, block_i)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+
+    # write-and-rename, other processes may be reading the same block
+    tmp_file = '{}.{}.{}'.format(cache_file, os.getpid(), threading.get_ident())
+    with open(tmp_file, 'wb') as OUT:
+        OUT.write(data)
+    os.replace(tmp_file, cache_file)
+
+
+def _read_s3_ranges(path, ranges):
+    bucket, key = split_s3(path)
+    etag = object_info(path)[1]
+    block_size = config['block_size']
+
+    needed = sorted({b for offset, size in ranges if size > 0
+                     for b in range(offset // block_size,
+                                    (offset + size - 1) // block_size + 1)})
+
+    blocks = {b: _read_cached_block(bucket, key, etag, b) for b in needed}
+
+    # one ranged GET for each run of consecutive missing blocks. IfMatch fails
+    # the read if the object changed since it was listed, rather than caching
+    # the new bytes under the old ETag
+    for start, stop in coalesce((b, b + 1) for b in needed if blocks[b] is None):
+        response = get_client().get_object(
+                Bucket=bucket, Key=key, IfMatch=etag,
+                Range='bytes={}-{}'.format(start * block_size,
+                                           stop * block_size - 1)
+        )
+        data = response['Body'].read()
+
+        for b in range(start, stop):
+            blocks[b] = data[(b - start) * block_size:(b - start + 1) * block_size]
+            _write_cached_block(bucket, key, etag, b, blocks[b])
+
+    results = []
+    for offset, size in ranges:
+        if size <= 0:
+            results.append(b'')
+            continue
+
+        first = offset // block_size
+        last = (offset + size - 1) // block_size
+        data = b''.join(blocks[b] for b in range(first, last + 1))
+        start = offset - first * block_size
+        results.append(data[start:start + size])
+
+    return results
+
+
+def read_ranges(path, ranges):
+    # ranges is a list of (offset, size), size None means to the end of file
+    ranges = [(offset, object_size(path) - offset if size is None else size)
+              for offset, size in ranges]
+
+    if is_s3(path):
+        return _read_s3_ranges(path, ranges)
+
+    results = []
+    with open(path, 'rb') as f:
+        for offset, size in ranges:
+            f.seek(offset)
+            results.append(f.read(size))
+
+    return results
+
+
+def read_range(path, offset=0, size=None):
+    return read_ranges(path, [(offset, size)])[0]
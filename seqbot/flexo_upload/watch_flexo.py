@@ -3,17 +3,23 @@
 # they are finished.
 
 
+import base64
 import glob
+import hashlib
 import logging
 import os
 import subprocess
 import sys
 import time
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from logging.handlers import TimedRotatingFileHandler
 
 import boto3
 
+from botocore.exceptions import ClientError
+
 
 ROOT_DIR = '/mnt/SEQS'
 SEQS = ['MiSeq-01', 'NextSeq-01', 'NovaSeq-01']
@@ -29,6 +35,14 @@ S3_BCL_DIR = 'bcl'
 # time to sleep between uploads
 SLEEPY_TIME = 0.001 # 1/1000th of a second between every file...
 
+# same as boto3's upload_file defaults, so the ETags of files that were
+# uploaded with it can be reproduced locally
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+
+# parts uploaded at once; at most one more is buffered while it's hashed
+MAX_CONCURRENT_PARTS = 4
+
 
 def maybe_exit_process():
     # get all python pids
@@ -61,7 +75,9 @@ def scan_dir(seq_dir, client, logger):
             Bucket=S3_BUCKET, Prefix=os.path.join(S3_BCL_DIR, run_name)
     )
 
-    file_set = {r['Key'] for result in response_iterator
+    # key -> (size, etag) so uploads can be verified without rereading files
+    file_set = {r['Key']: (r['Size'], r['ETag'].strip('"'))
+                for result in response_iterator
                 for r in result.get('Contents', [])}
     logger.info("Found {} objects in {}".format(
             len(file_set), os.path.join(S3_BUCKET, S3_BCL_DIR, run_name))
@@ -70,7 +86,149 @@ def scan_dir(seq_dir, client, logger):
     return file_set
 
 
-def main(logger, upload_set):
+def read_parts(file_name):
+    # yields each multipart-sized chunk of a file with its md5
+    with open(file_name, 'rb') as f:
+        while True:
+            part = f.read(MULTIPART_CHUNKSIZE)
+            if not part:
+                break
+            yield part, hashlib.md5(part)
+
+
+def s3_etag(md5, part_md5s, size):
+    # single uploads use the md5 of the file, multipart uploads the md5 of
+    # the concatenated part digests plus the number of parts
+    if size < MULTIPART_THRESHOLD:
+        return md5.hexdigest()
+    else:
+        return '{}-{}'.format(
+                hashlib.md5(b''.join(m.digest() for m in part_md5s)).hexdigest(),
+                len(part_md5s)
+        )
+
+
+def digest_file(file_name, size):
+    md5 = hashlib.md5()
+    part_md5s = []
+
+    for part, part_md5 in read_parts(file_name):
+        md5.update(part)
+        part_md5s.append(part_md5)
+
+    return md5.hexdigest(), s3_etag(md5, part_md5s, size)
+
+
+def upload_file(client, file_name, s3_key, size):
+    # uploads in a single pass over the file: each part is hashed as it's
+    # read, sent with its Content-MD5 (so S3 rejects corrupted parts), and
+    # the resulting ETag is checked against the one computed locally
+    md5 = hashlib.md5()
+    part_md5s = []
+
+    if size < MULTIPART_THRESHOLD:
+        data = b''.join(part for part, part_md5 in read_parts(file_name))
+        md5.update(data)
+        part_md5s.append(md5.copy())
+
+        response = client.put_object(
+                Bucket=S3_BUCKET, Key=s3_key, Body=data,
+                ContentMD5=base64.b64encode(md5.digest()).decode()
+        )
+    else:
+        upload_id = client.create_multipart_upload(
+                Bucket=S3_BUCKET, Key=s3_key)['UploadId']
+
+        def upload_part(part_number, part, part_md5):
+            part_response = client.upload_part(
+                    Bucket=S3_BUCKET, Key=s3_key, UploadId=upload_id,
+                    PartNumber=part_number, Body=part,
+                    ContentMD5=base64.b64encode(part_md5.digest()).decode()
+            )
+            return {'ETag': part_response['ETag'], 'PartNumber': part_number}
+
+        try:
+            # parts are hashed as they're read and sent on a few threads,
+            # waiting for the oldest one whenever too many are in flight
+            parts = []
+            with ThreadPoolExecutor(MAX_CONCURRENT_PARTS) as executor:
+                in_flight = deque()
+                for part_number, (part, part_md5) in enumerate(read_parts(file_name), 1):
+                    md5.update(part)
+                    part_md5s.append(part_md5)
+
+                    if len(in_flight) == MAX_CONCURRENT_PARTS:
+                        parts.append(in_flight.popleft().result())
+                    in_flight.append(executor.submit(upload_part, part_number,
+                                                     part, part_md5))
+
+                parts.extend(future.result() for future in in_flight)
+
+            response = client.complete_multipart_upload(
+                    Bucket=S3_BUCKET, Key=s3_key, UploadId=upload_id,
+                    MultipartUpload={'Parts': parts}
+            )
+        except:
+            client.abort_multipart_upload(Bucket=S3_BUCKET, Key=s3_key,
+                                          UploadId=upload_id)
+            raise
+
+    etag = s3_etag(md5, part_md5s, size)
+    if response['ETag'].strip('"') != etag:
+        raise IOError('ETag mismatch for {}: expected {}, got {}'.format(
+                s3_key, etag, response['ETag'])
+        )
+
+    return md5.hexdigest(), etag
+
+
+def read_digest_record(digest_record_file):
+    # local file -> (size, mtime, md5, etag)
+    digests = dict()
+
+    if os.path.exists(digest_record_file):
+        with open(digest_record_file) as f:
+            for line in f:
+                file_name, size, mtime, md5, etag = line.rstrip('\n').split('\t')
+                digests[file_name] = (int(size), float(mtime), md5, etag)
+
+    return digests
+
+
+def write_digest_record(digest_record_file, digests):
+    tmp_file = digest_record_file + '.tmp'
+    with open(tmp_file, 'w') as OUT:
+        for file_name in sorted(digests):
+            size, mtime, md5, etag = digests[file_name]
+            OUT.write('{}\t{}\t{!r}\t{}\t{}\n'.format(file_name, size, mtime,
+                                                    md5, etag))
+    os.rename(tmp_file, digest_record_file)
+
+
+def prune_digests(digests, upload_set):
+    # drops the digests of files in runs that are already synced (they won't
+    # be scanned again) or whose directory is gone, so the record doesn't grow
+    # with every run ever uploaded
+    dir_status = dict()
+
+    def keep(dir_name):
+        if dir_name not in dir_status:
+            parent = os.path.dirname(dir_name)
+            if dir_name in upload_set or not os.path.isdir(dir_name):
+                dir_status[dir_name] = False
+            elif parent == dir_name:
+                dir_status[dir_name] = True
+            else:
+                dir_status[dir_name] = keep(parent)
+
+        return dir_status[dir_name]
+
+    for local_file in list(digests):
+        if not keep(os.path.dirname(local_file)):
+            del digests[local_file]
+
+
+def main(logger, upload_set, digests):
     logger.debug("Creating S3 client")
     client = boto3.client('s3')
 
@@ -97,6 +255,7 @@ def main(logger, upload_set):
 
                     num_files = 0
                     uploaded_files = 0
+                    verified_files = 0
 
                     seq_root = os.path.dirname(seq_dir)
                     for root, dirs, files in os.walk(seq_dir, topdown=True):
@@ -105,23 +264,62 @@ def main(logger, upload_set):
                         base_dir = root[(len(seq_root) + 1):]
 
                         for file_name in files:
+                            local_file = os.path.join(root, file_name)
                             s3_key = os.path.join(S3_BCL_DIR, base_dir,
                                                   file_name)
-                            if s3_key not in file_set:
-                                logger.debug('uploading {} to {}'.format(
-                                        file_name, s3_key)
+
+                            try:
+                                st = os.stat(local_file)
+                            except OSError:
+                                logger.warning("couldn't stat {}".format(
+                                        file_name)
                                 )
+                                continue
+
+                            # digests are only trusted if the file hasn't
+                            # changed since they were computed
+                            record = digests.get(local_file)
+                            if record and record[:2] != (st.st_size, st.st_mtime):
+                                record = None
+
+                            remote = file_set.get(s3_key)
+
+                            # uploaded before digests were recorded: one read
+                            # to check it rather than uploading it again
+                            if (remote and record is None
+                                and remote[0] == st.st_size):
                                 try:
-                                    client.upload_file(
-                                        Filename=os.path.join(root, file_name),
-                                        Bucket=S3_BUCKET,
-                                        Key=s3_key)
-                                    synced_files += 1
+                                    record = (st.st_size, st.st_mtime) + digest_file(
+                                            local_file, st.st_size
+                                    )
+                                    digests[local_file] = record
                                 except IOError:
                                     logger.warning("couldn't read {}".format(
                                             file_name)
                                     )
-                                time.sleep(SLEEPY_TIME)
+                                    continue
+
+                            if remote and record and remote == (record[0], record[3]):
+                                verified_files += 1
+                                continue
+                            elif remote:
+                                logger.info('{} differs from {}, re-uploading'.format(
+                                        file_name, s3_key)
+                                )
+
+                            logger.debug('uploading {} to {}'.format(
+                                    file_name, s3_key)
+                            )
+                            try:
+                                digests[local_file] = (st.st_size, st.st_mtime) + upload_file(
+                                    client, local_file, s3_key, st.st_size
+                                )
+                                synced_files += 1
+                            except (IOError, ClientError) as detail:
+                                logger.warning("couldn't upload {}: {}".format(
+                                        file_name, detail)
+                                )
+                            time.sleep(SLEEPY_TIME)
 
                         if synced_files:
                             logger.debug('synced {} files in {}'.format(
@@ -129,7 +327,7 @@ def main(logger, upload_set):
                             )
                             uploaded_files += synced_files
 
-                    if (uploaded_files + len(file_set)) == num_files:
+                    if (uploaded_files + verified_files) == num_files:
                         logger.info('{} is synced'.format(seq_dir))
                         upload_set.add(seq_dir)
                         logger.debug('added {} for upload_set'.format(seq_dir))
@@ -139,6 +337,12 @@ def main(logger, upload_set):
     logger.info("sync complete")
     logger.info("{} files uploaded".format(total_uploads))
 
+    n_digests = len(digests)
+    prune_digests(digests, upload_set)
+    logger.debug('pruned {} digests of synced runs'.format(
+            n_digests - len(digests))
+    )
+
     return upload_set
 
 
@@ -182,7 +386,16 @@ if __name__ == "__main__":
 
     mainlogger.info('{} runs recorded as uploaded'.format(len(old_upload_set)))
 
-    updated_upload_set = main(mainlogger, old_upload_set.copy())
+    # digests of uploaded files, so re-scans don't need to reread them
+    digest_record_file = '/home/utility/flexo_digests.txt'
+    digests = read_digest_record(digest_record_file)
+    mainlogger.info('{} file digests recorded'.format(len(digests)))
+
+    try:
+        updated_upload_set = main(mainlogger, old_upload_set.copy(), digests)
+    finally:
+        write_digest_record(digest_record_file, digests)
+        mainlogger.debug('wrote digest record file')
 
     mainlogger.info('synced {} new runs'.format(
             len(updated_upload_set) - len(old_upload_set))
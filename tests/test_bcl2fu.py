@@ -0,0 +1,172 @@
+import gzip
+import os
+from collections import Counter
+
+import numpy as np
+import pytest
+
+import seqbot.demuxer.bcl2fu as bcl2fu
+
+
+def random_bases(shape, seed=0):
+    # 0-3 for ACGT with some 4s for no-calls
+    rng = np.random.default_rng(seed)
+
+    byte_matrix = rng.integers(0, 4, shape).astype(np.uint8)
+    byte_matrix[rng.random(shape) < 0.05] = 4
+
+    return byte_matrix
+
+
+@pytest.mark.parametrize('n_cycles', [1, 8, 17, 32])
+def test_pack_bases(n_cycles):
+    byte_matrix = random_bases((1000, n_cycles))
+
+    packed, n_mask = bcl2fu.pack_bases(byte_matrix)
+
+    assert packed.dtype == np.uint64 and n_mask.dtype == np.uint32
+    assert np.array_equal(bcl2fu.unpack_bases(packed, n_mask, n_cycles),
+                          byte_matrix)
+
+
+def test_pack_bases_too_many_cycles():
+    with pytest.raises(ValueError):
+        bcl2fu.pack_bases(random_bases((10, bcl2fu.MAX_PACKED_CYCLES + 1)))
+
+
+def tile_block(n_clusters, seed=0, compresslevel=9):
+    # a gzipped CBCL tile block of random nibbles (2 bits of base, 2 of qbin)
+    rng = np.random.default_rng(seed)
+
+    nibbles = rng.integers(0, 16, n_clusters + n_clusters % 2).astype(np.uint8)
+    packed = nibbles[0::2] | (nibbles[1::2] << 4)
+
+    return gzip.compress(packed.tobytes(), compresslevel=compresslevel)
+
+
+def decode_chunks(block, n_clusters, chunk_clusters):
+    ci = bcl2fu.cbcl_info(1, 0, 2, 2, 0, None, 1, None, False)
+    cf = np.ones(n_clusters, dtype=bool)
+
+    return list(bcl2fu.decode_block_chunks(
+            ci, cf, block, bcl2fu.tile_chunks(n_clusters, chunk_clusters)
+    ))
+
+
+def test_decode_block_chunks():
+    block = tile_block(2001)
+
+    whole, = decode_chunks(block, 2001, None)
+    chunks = decode_chunks(block, 2001, 500)
+
+    assert len(chunks) == 5
+    assert np.array_equal(np.concatenate(chunks), whole)
+    assert np.array_equal(whole, bcl2fu.decode_basecalls(
+            np.frombuffer(gzip.decompress(block), dtype=np.uint8), 2001
+    ))
+
+
+@pytest.mark.parametrize('corrupt', ['data', 'crc', 'truncated'])
+def test_decode_corrupt_block(corrupt):
+    # a stored (uncompressed) gzip block, so a flipped data byte still
+    # inflates and is only caught by the CRC at the end of the stream
+    block = bytearray(tile_block(2000, compresslevel=0))
+    if corrupt == 'data':
+        block[len(block) // 2] ^= 0xff
+    elif corrupt == 'crc':
+        block[-8] ^= 0xff
+    else:
+        block = block[:len(block) // 2]
+
+    # the whole block is no-calls whether it's decoded in chunks or not
+    assert decode_chunks(bytes(block), 2000, None) == [None]
+    assert decode_chunks(bytes(block), 2000, 500) == [None] * 4
+
+
+def test_merge_sorted_counts():
+    rng = np.random.default_rng(0)
+
+    shards = [Counter(''.join(rng.choice(list('ACGTN'), 4))
+                      for _ in range(500))
+              for _ in range(3)]
+
+    merged = list(bcl2fu.merge_sorted_counts(
+            sorted(counts.items()) for counts in shards
+    ))
+
+    assert [read for read, _ in merged] == sorted(sum(shards, Counter()))
+    assert dict(merged) == sum(shards, Counter())
+
+
+@pytest.mark.parametrize('n_clusters', [0, 1, 7, 8, 9, 1001])
+def test_pack_cycles(n_clusters):
+    byte_matrix = random_bases((n_clusters, 5))
+
+    packed, n_mask = bcl2fu.pack_cycles(byte_matrix)
+
+    assert packed.shape == (5, -(-n_clusters // 4))
+    assert n_mask.shape == (5, -(-n_clusters // 8))
+    assert np.array_equal(bcl2fu.unpack_cycles(packed, n_mask, n_clusters),
+                          byte_matrix)
+
+
+def split_chunks(clusters, byte_matrix, chunk_sizes):
+    # (clusters, byte_matrix) chunks of the given sizes, then the rest
+    bounds = np.cumsum([0] + chunk_sizes + [clusters.shape[0]])
+    bounds = np.minimum(bounds, clusters.shape[0])
+
+    return [(clusters[a:b], byte_matrix[a:b])
+            for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+@pytest.mark.parametrize('n_clusters, chunk_sizes', [
+        (0, []),
+        (0, [0, 0]),
+        (5, [3]),
+        (100, [3, 5, 13, 1, 0, 7]),
+        (1003, [250, 250, 250]),
+        (1003, [8] * 50 + [1] * 9),
+])
+def test_write_store_tile(tmp_path, n_clusters, chunk_sizes):
+    cycles = [3, 4, 5, 6, 7]
+    clusters = np.arange(n_clusters, dtype=np.uint32) * 3
+    byte_matrix = random_bases((n_clusters, len(cycles)))
+
+    lane_dir = str(tmp_path / 'lane=1')
+    bcl2fu.write_store_tile(
+            lane_dir, 1101, cycles, n_clusters,
+            split_chunks(clusters, byte_matrix, chunk_sizes)
+    )
+
+    st = bcl2fu.open_store_tile(str(tmp_path), 1, 1101)
+    assert st.cycles.tolist() == cycles
+    assert np.array_equal(st.clusters, clusters)
+    assert np.array_equal(bcl2fu.unpack_store_tile(st), byte_matrix)
+
+    # a range of cycles, unpacked in chunks
+    for chunk_clusters in (None, 8, 13, 500):
+        chunks = list(bcl2fu.extract_store_tiles(str(tmp_path), 1, 0, 1,
+                                                 [4, 5, 6], chunk_clusters))
+
+        assert all(tile == 1101 and pf.all() for tile, _, pf, _ in chunks)
+        assert all(len(c) % 8 == 0 for _, c, _, _ in chunks[:-1])
+        if n_clusters:
+            assert np.array_equal(np.concatenate([c for _, c, _, _ in chunks]),
+                                  clusters)
+            assert np.array_equal(np.concatenate([m for _, _, _, m in chunks]),
+                                  byte_matrix[:, 1:4])
+
+
+def test_write_store_tile_wrong_count(tmp_path):
+    byte_matrix = random_bases((20, 2))
+    clusters = np.arange(20, dtype=np.uint32)
+
+    for n_clusters in (19, 21):
+        with pytest.raises(ValueError):
+            bcl2fu.write_store_tile(
+                    str(tmp_path), 1101, [1, 2], n_clusters,
+                    split_chunks(clusters, byte_matrix, [9])
+            )
+
+    # a failed tile leaves nothing behind
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,79 @@
+import gzip
+import os
+
+import pytest
+
+import seqbot.demuxer.checkpoint as checkpoint
+
+
+def write_output(output_dir, name, data):
+    out_file = os.path.join(output_dir, name)
+    with checkpoint.hashed_output(out_file) as OUT:
+        with gzip.open(OUT, 'wb') as GZ:
+            GZ.write(data)
+
+    return out_file, OUT.hexdigest()
+
+
+def test_hashed_output(tmp_path):
+    out_file, md5 = write_output(str(tmp_path), 'out.txt.gz', b'ACGT\n' * 1000)
+
+    assert md5 == checkpoint.file_md5(out_file)
+    assert os.listdir(str(tmp_path)) == ['out.txt.gz']
+
+    with pytest.raises(RuntimeError):
+        with checkpoint.hashed_output(str(tmp_path / 'failed.txt.gz')) as OUT:
+            OUT.write(b'partial')
+            raise RuntimeError()
+
+    # a failed output leaves nothing behind, not even its temporary file
+    assert os.listdir(str(tmp_path)) == ['out.txt.gz']
+
+
+def test_resume(tmp_path):
+    output_dir = str(tmp_path)
+    params = {'bcl_path': 'run', 'index_cycle_start': 1}
+    units = [(lane, None, 0, None, i, 4) for lane in (1, 2) for i in range(4)]
+
+    with checkpoint.open_manifest(output_dir, params, dict()) as manifest:
+        for n, unit in enumerate(units):
+            out_file, md5 = write_output(output_dir,
+                                         'index_reads_{}.txt.gz'.format(n),
+                                         'reads {}\n'.format(n).encode())
+            checkpoint.record_unit(manifest, output_dir, unit, out_file, md5)
+
+    # one output is corrupted, one is deleted, one is written but its line is
+    # torn, and the last unit is never recorded
+    with open(os.path.join(output_dir, 'index_reads_1.txt.gz'), 'r+b') as f:
+        last_byte = f.read()[-1]
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last_byte ^ 0xff]))
+    os.remove(os.path.join(output_dir, 'index_reads_2.txt.gz'))
+
+    manifest_file = os.path.join(output_dir, checkpoint.MANIFEST_FILE)
+    with open(manifest_file) as f:
+        lines = f.readlines()
+    with open(manifest_file, 'w') as OUT:
+        OUT.writelines(lines[:-2])
+        OUT.write(lines[-2][:-10])
+
+    read_params, completed = checkpoint.read_manifest(output_dir)
+    assert read_params == params
+    assert sorted(completed) == [checkpoint.unit_key(unit)
+                                 for unit in units[:6]]
+
+    completed = checkpoint.verify_outputs(output_dir, completed)
+    assert sorted(completed) == [checkpoint.unit_key(units[n])
+                                 for n in (0, 3, 4, 5)]
+
+    # an extra check can reject more units
+    completed = checkpoint.verify_outputs(
+            output_dir, completed,
+            lambda out_file: not out_file.endswith('_4.txt.gz')
+    )
+    assert sorted(completed) == [checkpoint.unit_key(units[n])
+                                 for n in (0, 3, 5)]
+
+    # the kept units are carried into the next run's manifest
+    checkpoint.open_manifest(output_dir, params, completed).close()
+    assert checkpoint.read_manifest(output_dir) == (params, completed)
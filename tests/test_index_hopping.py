@@ -0,0 +1,40 @@
+import numpy as np
+
+import seqbot.demuxer.index_hopping as index_hopping
+
+
+def test_pair_counts():
+    rng = np.random.default_rng(0)
+
+    sample_indexes = [(None, 'ACGTAC', 'TTGCA'), (None, 'GGATCC', 'CAGTA'),
+                      (None, 'CTTAGA', 'TTGCA'), (None, 'AAAAAA', 'GCGCG')]
+    di = index_hopping.get_dual_index(sample_indexes, 8)
+
+    # reads are a mix of expected barcodes (in any pairing), random bases and
+    # no-calls, with 2 extra i7 cycles and 1 extra i5 cycle
+    expected = lambda seqs, n: np.array(
+            [['ACGT'.index(c) for c in s] for s in seqs], dtype=np.uint8
+    )[rng.integers(0, len(seqs), n)]
+
+    n_reads = 5000
+    byte_matrix = np.concatenate([
+            expected(di.i7, n_reads), rng.integers(0, 4, (n_reads, 2)),
+            expected(di.i5, n_reads), rng.integers(0, 4, (n_reads, 1))
+    ], axis=1).astype(np.uint8)
+
+    random_rows = rng.random(n_reads) < 0.2
+    byte_matrix[random_rows] = rng.integers(0, 4, (random_rows.sum(), 14))
+    byte_matrix[rng.random(byte_matrix.shape) < 0.01] = 4
+
+    matrix = index_hopping.pair_counts(byte_matrix, di)
+
+    brute = np.zeros((len(di.i7) + 1, len(di.i5) + 1), dtype=int)
+    for row in byte_matrix:
+        read = ''.join('ACGTN'[b] for b in row)
+        i7 = read[:len(di.i7[0])]
+        i5 = read[di.i7_cycles:di.i7_cycles + len(di.i5[0])]
+        brute[di.i7.index(i7) if i7 in di.i7 else len(di.i7),
+              di.i5.index(i5) if i5 in di.i5 else len(di.i5)] += 1
+
+    assert np.array_equal(matrix, brute)
+    assert matrix.sum() == n_reads
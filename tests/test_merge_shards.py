@@ -0,0 +1,47 @@
+import gzip
+from collections import Counter
+
+import numpy as np
+import pytest
+
+pytest.importorskip('utilities')
+
+import seqbot.demuxer.merge_shards as merge_shards
+
+
+def write_counts(path, counts):
+    with gzip.open(str(path), 'wt') as OUT:
+        for read, count in sorted(counts.items()):
+            print('{}\t{}'.format(read, count), file=OUT)
+
+
+def test_sum_counts(tmp_path):
+    rng = np.random.default_rng(0)
+
+    shards = [Counter(''.join(rng.choice(list('ACGTN'), 4))
+                      for _ in range(500))
+              for _ in range(3)]
+    for i, counts in enumerate(shards):
+        write_counts(tmp_path / 'index_counts_{}.txt.gz'.format(i), counts)
+
+    out_file = str(tmp_path / 'index_counts.txt.gz')
+    merge_shards.sum_counts(
+            [str(tmp_path / 'index_counts_{}.txt.gz'.format(i))
+             for i in range(3)],
+            out_file
+    )
+
+    with gzip.open(out_file, 'rt') as f:
+        rows = [line.split('\t') for line in f]
+
+    assert [read for read, _ in rows] == sorted(sum(shards, Counter()))
+    assert {read: int(count) for read, count in rows} == sum(shards, Counter())
+
+
+def test_sum_counts_unsorted(tmp_path):
+    in_file = str(tmp_path / 'index_counts_0.txt.gz')
+    with gzip.open(in_file, 'wt') as OUT:
+        print('CCCC\t1\nAAAA\t2', file=OUT)
+
+    with pytest.raises(ValueError):
+        merge_shards.sum_counts([in_file], str(tmp_path / 'out.txt.gz'))
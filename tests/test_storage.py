@@ -0,0 +1,128 @@
+import gzip
+import os
+import struct
+
+import boto3
+import numpy as np
+import pytest
+
+moto = pytest.importorskip('moto')
+
+import seqbot.demuxer.bcl2fu as bcl2fu
+import seqbot.demuxer.storage as storage
+
+
+BUCKET = 'seqbot-test'
+RUN = 's3://{}/runs/run1'.format(BUCKET)
+
+
+def cbcl_bytes(tiles, n_clusters):
+    # a CBCL file with one all-A block of n_clusters per tile
+    blocks = [gzip.compress(bytes((n_clusters + 1) // 2)) for _ in tiles]
+    rows = [(tile, n_clusters, (n_clusters + 1) // 2, len(block))
+            for tile, block in zip(tiles, blocks)]
+
+    bins = np.array([[0, 2], [1, 12], [2, 23], [3, 37]], dtype=np.uint32)
+    body = (struct.pack('<BBI', 2, 2, len(bins)) + bins.tobytes()
+            + struct.pack('<I', len(rows))
+            + np.array(rows, dtype=np.uint32).tobytes()
+            + struct.pack('B', 0))
+
+    return struct.pack('<HI', 1, 6 + len(body)) + body + b''.join(blocks)
+
+
+@pytest.fixture
+def s3(tmp_path):
+    saved_config = dict(storage.config)
+
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+
+        storage.configure(endpoint_url=None,
+                          cache_dir=str(tmp_path / 'cache'),
+                          block_size=16)
+        yield client
+
+    storage.config.update(saved_config)
+    storage.configure()
+
+
+@pytest.fixture(autouse=True)
+def aws_env(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+
+def test_read_ranges(s3):
+    data = bytes(range(200))
+    s3.put_object(Bucket=BUCKET, Key='obj', Body=data)
+    path = 's3://{}/obj'.format(BUCKET)
+
+    ranges = [(0, 5), (10, 40), (150, None), (60, 0)]
+    expected = [data[0:5], data[10:50], data[150:], b'']
+
+    assert storage.read_ranges(path, ranges) == expected
+    # the second read comes from the block cache
+    assert storage.read_ranges(path, ranges) == expected
+    assert storage.read_range(path, 190) == data[190:]
+
+
+def test_rewritten_object_is_not_stale(s3):
+    path = 's3://{}/obj'.format(BUCKET)
+
+    s3.put_object(Bucket=BUCKET, Key='obj', Body=b'a' * 64)
+    assert storage.read_range(path, 0, 64) == b'a' * 64
+
+    s3.put_object(Bucket=BUCKET, Key='obj', Body=b'b' * 64)
+    storage.configure()
+    assert storage.read_range(path, 0, 64) == b'b' * 64
+
+
+def test_prune_cache(s3):
+    s3.put_object(Bucket=BUCKET, Key='obj', Body=bytes(256))
+    storage.read_range('s3://{}/obj'.format(BUCKET))
+
+    cache_dir = storage.config['cache_dir']
+    cache_size = lambda: sum(
+            os.path.getsize(os.path.join(dir_path, fn))
+            for dir_path, _, file_names in os.walk(cache_dir)
+            for fn in file_names
+    )
+    assert cache_size() == 256
+
+    storage.prune_cache(100)
+    assert cache_size() <= 100
+
+
+def test_cbcl_globber(s3):
+    basecalls = 'runs/run1/Data/Intensities/BaseCalls'
+    for lane in (1, 2):
+        for cycle in (1, 2, 3):
+            for part, tiles in ((1, [1101, 1102]), (2, [2101])):
+                s3.put_object(
+                        Bucket=BUCKET,
+                        Key='{}/L{:03d}/C{}.1/L{:03d}_{}.cbcl'.format(
+                                basecalls, lane, cycle, lane, part),
+                        Body=cbcl_bytes(tiles, 11)
+                )
+
+        for tile in (1101, 1102, 2101):
+            s3.put_object(
+                    Bucket=BUCKET,
+                    Key='{}/L{:03d}/s_{}_{}.filter'.format(basecalls, lane,
+                                                          lane, tile),
+                    Body=struct.pack('III', 0, 3, 11) + bytes([1] * 11)
+            )
+
+    cbcl_file_lists, cbcl_filter_lists = bcl2fu.cbcl_globber(RUN)
+
+    assert sorted(cbcl_file_lists) == [(1, 1), (1, 2), (2, 1), (2, 2)]
+    assert [bcl2fu.get_cycle(fn) for fn in cbcl_file_lists[1, 1]] == [1, 2, 3]
+    assert [bcl2fu.get_tile(fn) for fn in cbcl_filter_lists[2]] == [1101, 1102,
+                                                                    2101]
+
+    ci = bcl2fu.read_cbcl_header(cbcl_file_lists[1, 1][0])
+    assert ci.tiles[:, 0].tolist() == [1101, 1102]
+    assert bcl2fu.read_tile_filter(cbcl_filter_lists[1][0]).all()
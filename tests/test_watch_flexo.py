@@ -0,0 +1,69 @@
+import os
+
+import boto3
+import pytest
+
+moto = pytest.importorskip('moto')
+
+import seqbot.flexo_upload.watch_flexo as watch_flexo
+
+
+MiB = 1024 * 1024
+
+
+@pytest.fixture(autouse=True)
+def aws_env(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+
+@pytest.fixture
+def s3():
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=watch_flexo.S3_BUCKET)
+        yield client
+
+
+@pytest.mark.parametrize('size', [0, 100, 8 * MiB, 17 * MiB])
+def test_upload_file(s3, tmp_path, size):
+    local_file = str(tmp_path / 'file.bin')
+    with open(local_file, 'wb') as OUT:
+        OUT.write(os.urandom(size))
+
+    # the ETag S3 gives a file uploaded with boto3's defaults
+    s3.upload_file(local_file, watch_flexo.S3_BUCKET, 'boto3')
+    boto3_etag = s3.head_object(Bucket=watch_flexo.S3_BUCKET,
+                                Key='boto3')['ETag'].strip('"')
+
+    md5, etag = watch_flexo.digest_file(local_file, size)
+    assert etag == boto3_etag
+
+    assert watch_flexo.upload_file(s3, local_file, 'flexo', size) == (md5, etag)
+    assert s3.head_object(Bucket=watch_flexo.S3_BUCKET,
+                          Key='flexo')['ETag'].strip('"') == boto3_etag
+
+    body = s3.get_object(Bucket=watch_flexo.S3_BUCKET, Key='flexo')['Body']
+    with open(local_file, 'rb') as f:
+        assert body.read() == f.read()
+
+
+def test_failed_upload_is_aborted(s3, tmp_path, monkeypatch):
+    local_file = str(tmp_path / 'file.bin')
+    with open(local_file, 'wb') as OUT:
+        OUT.write(os.urandom(17 * MiB))
+
+    upload_part = s3.upload_part
+    def failing_upload_part(**kwargs):
+        if kwargs['PartNumber'] == 2:
+            raise IOError('connection reset')
+        return upload_part(**kwargs)
+
+    monkeypatch.setattr(s3, 'upload_part', failing_upload_part)
+
+    with pytest.raises(IOError):
+        watch_flexo.upload_file(s3, local_file, 'flexo', 17 * MiB)
+
+    uploads = s3.list_multipart_uploads(Bucket=watch_flexo.S3_BUCKET)
+    assert not uploads.get('Uploads')